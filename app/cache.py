@@ -0,0 +1,100 @@
+# In-process cache of serialized table payloads, so each table version is encoded only once,
+# and map of the latest known table versions used to answer conditional GETs without the database
+# Both maps keep only recently used tables, so finished games don't stay in the worker forever
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# How long (in seconds) a remembered version is trusted without reloading the table
+VERSION_MAP_TTL = float(os.getenv("VERSION_MAP_TTL", "2"))
+# Tables kept in each map, least recently used ones are dropped above it
+CACHE_MAX_TABLES = int(os.getenv("CACHE_MAX_TABLES", "10000"))
+
+# table_id -> (version, encoded payload)
+STATE_PAYLOADS = OrderedDict()
+
+# table_id -> (etag, monotonic time until which the etag is trusted)
+TABLE_VERSIONS = OrderedDict()
+
+cache_lock = threading.Lock()
+
+
+def get_cached(cache: OrderedDict, table_id: int):
+    with cache_lock:
+        value = cache.get(table_id)
+        if value is not None:
+            cache.move_to_end(table_id)
+        return value
+
+
+def put_cached(cache: OrderedDict, table_id: int, value):
+    with cache_lock:
+        cache[table_id] = value
+        cache.move_to_end(table_id)
+        if len(cache) > CACHE_MAX_TABLES:
+            cache.popitem(last=False)
+
+
+def forget_version(table_id: int):
+    with cache_lock:
+        TABLE_VERSIONS.pop(table_id, None)
+
+
+def forget_table(table_id: int):
+    with cache_lock:
+        STATE_PAYLOADS.pop(table_id, None)
+        TABLE_VERSIONS.pop(table_id, None)
+
+
+def get_state_payload(table) -> bytes:
+    # Version and state of live table are read under its lock, so the payload is stored under its own version
+    with table.lock():
+        version = table.get_version()
+        cached = get_cached(STATE_PAYLOADS, table.table_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        payload = json.dumps(table.get_state()).encode()
+    put_cached(STATE_PAYLOADS, table.table_id, (version, payload))
+    return payload
+
+
+def get_etag(table) -> str:
+    return '"%d-%d-%d"' % table.get_version()
+
+
+# Remembers current version of the table, returns its etag
+def remember_version(table) -> str:
+    etag = get_etag(table)
+    trusted_for = VERSION_MAP_TTL
+    # Flag fall changes the result without any request, so don't trust the version past it
+    seconds_to_flag = table.get_seconds_to_flag()
+    if seconds_to_flag is not None:
+        trusted_for = max(0.0, min(trusted_for, seconds_to_flag))
+    put_cached(TABLE_VERSIONS, table.table_id, (etag, time.monotonic() + trusted_for))
+    return etag
+
+
+# Returns current etag of the table if client already has it, None otherwise
+def get_unmodified_etag(table_id: int, if_none_match: str) -> Optional[str]:
+    if if_none_match is None:
+        return None
+
+    known = get_cached(TABLE_VERSIONS, table_id)
+    if known is None:
+        return None
+
+    etag, valid_until = known
+    if time.monotonic() >= valid_until:
+        return None
+
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return etag
+    return None
@@ -0,0 +1,69 @@
+# Chess clocks counted in integer milliseconds. Current time comes from monotonic clock shifted to
+# epoch, so it never goes back within a worker and still compares with times saved by other workers.
+import os
+import time
+from datetime import datetime
+from typing import Optional
+
+EPOCH_OFFSET_MS = time.time_ns() // 1000000 - time.monotonic_ns() // 1000000
+
+# Default time control, in seconds
+DEFAULT_BASE_TIME = float(os.getenv("DEFAULT_BASE_TIME", "180"))
+DEFAULT_INCREMENT = float(os.getenv("DEFAULT_INCREMENT", "0"))
+DEFAULT_DELAY = float(os.getenv("DEFAULT_DELAY", "0"))
+
+# Clocks are saved as 32-bit integers
+MAX_BASE_TIME_MS = 24 * 60 * 60 * 1000
+MAX_INCREMENT_MS = 10 * 60 * 1000
+
+
+def now_ms() -> int:
+    return time.monotonic_ns() // 1000000 + EPOCH_OFFSET_MS
+
+
+def seconds_to_ms(seconds: float) -> int:
+    return int(round(seconds * 1000))
+
+
+# None stays None, clock of provisioned table isn't running before its first move
+def ms_to_iso(ms: Optional[int]) -> Optional[str]:
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(ms / 1000).isoformat()
+
+
+# Base time of every player, increment added after each move and delay during which clock doesn't run
+class TimeControl:
+    __slots__ = ('base_ms', 'increment_ms', 'delay_ms')
+
+    def __init__(self, base_ms: int, increment_ms: int = 0, delay_ms: int = 0):
+        self.base_ms = base_ms
+        self.increment_ms = increment_ms
+        self.delay_ms = delay_ms
+
+    def is_valid(self) -> bool:
+        return 0 < self.base_ms <= MAX_BASE_TIME_MS and 0 <= self.increment_ms <= MAX_INCREMENT_MS \
+               and 0 <= self.delay_ms <= MAX_INCREMENT_MS
+
+    def __eq__(self, other):
+        return isinstance(other, TimeControl) and self.base_ms == other.base_ms \
+               and self.increment_ms == other.increment_ms and self.delay_ms == other.delay_ms
+
+    # Time used by move which took elapsed_ms
+    def get_used_ms(self, elapsed_ms: int) -> int:
+        return max(0, elapsed_ms - self.delay_ms)
+
+    # Clock of player after move which took elapsed_ms, increment is not added once player has flagged
+    def charge(self, time_left_ms: int, elapsed_ms: int) -> int:
+        time_left_ms -= self.get_used_ms(elapsed_ms)
+        if time_left_ms >= 0:
+            time_left_ms += self.increment_ms
+        return time_left_ms
+
+
+DEFAULT_TIME_CONTROL = TimeControl(seconds_to_ms(DEFAULT_BASE_TIME), seconds_to_ms(DEFAULT_INCREMENT),
+                                   seconds_to_ms(DEFAULT_DELAY))
+
+
+def get_time_control(base_time: float, increment: float, delay: float) -> TimeControl:
+    return TimeControl(seconds_to_ms(base_time), seconds_to_ms(increment), seconds_to_ms(delay))
@@ -4,14 +4,70 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 SQLALCHEMY_DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL")
+# Reads that may lag behind a little (fen, times, listings) go to replica when it is configured
+SQLALCHEMY_READ_REPLICA_URL = os.getenv("SQLALCHEMY_READ_REPLICA_URL")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Connection pool, sized per worker process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+# Number of compiled statements kept by each engine
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "500"))
+
+# Engines are created on first use, so importing the app doesn't load database driver
+engine = None
+read_engine = None
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+
+def create_pooled_engine(url: str):
+    return create_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        query_cache_size=DB_QUERY_CACHE_SIZE,
+    )
+
+
+def get_engine():
+    global engine
+    if engine is None:
+        engine = create_pooled_engine(SQLALCHEMY_DATABASE_URL)
+        SessionLocal.configure(bind=engine)
+    return engine
+
+
+# Falls back to primary when no replica is configured
+def get_read_engine():
+    global read_engine
+    if read_engine is None:
+        if SQLALCHEMY_READ_REPLICA_URL:
+            read_engine = create_pooled_engine(SQLALCHEMY_READ_REPLICA_URL)
+        else:
+            read_engine = get_engine()
+        ReadSessionLocal.configure(bind=read_engine)
+    return read_engine
 
 
 def get_db():
+    get_engine()
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+def get_read_db():
+    get_read_engine()
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
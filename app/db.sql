@@ -1,5 +1,6 @@
 DROP TABLE IF EXISTS games;
 DROP TABLE IF EXISTS players;
+DROP TABLE IF EXISTS outbox;
 
 CREATE TABLE IF NOT EXISTS games (
     "game_id" SERIAL,
@@ -9,20 +10,51 @@ CREATE TABLE IF NOT EXISTS games (
     "black_two_id" integer,
     "halfmoves" integer,
     "result" integer,
-    "game_start_time" VARCHAR(300),
-    "last_move_time" VARCHAR(300),
-    "fen" VARCHAR(300)
+    -- Milliseconds since epoch
+    "game_start_ms" bigint,
+    "last_move_ms" bigint,
+    "fen" VARCHAR(300),
+    -- Hashes of positions since last capture or pawn move, for threefold repetition
+    "position_hashes" bigint[] DEFAULT '{}',
+    -- Time control: base time of each player, increment after every move, delay before clock runs
+    "base_time_ms" integer,
+    "increment_ms" integer DEFAULT 0,
+    "delay_ms" integer DEFAULT 0
 );
 
 ALTER TABLE games
     ADD CONSTRAINT pk_games PRIMARY KEY ("game_id");
 
+-- Lookups of live tables skip finished and aborted ones
+CREATE INDEX games_live ON games ("game_id") WHERE "result" = 400;
+
 CREATE TABLE IF NOT EXISTS players (
     "player_id" SERIAL,
     "nickname" character varying(100),
     "token" character varying(256),
-    "time_left" integer
+    "time_left_ms" integer,
+    -- Move queued for the next turn of the player, packed like moves of the journal
+    "premove" integer
 );
 
 ALTER TABLE players
     ADD CONSTRAINT pk_players PRIMARY KEY ("player_id");
+
+-- Leaderboard events waiting to be published, written together with game result
+CREATE TABLE IF NOT EXISTS outbox (
+    "event_id" SERIAL,
+    "table_id" integer,
+    "nickname" character varying(100),
+    "result" character varying(10),
+    -- Milliseconds since epoch, sent_ms is empty until relay publishes the event
+    "created_ms" bigint,
+    "sent_ms" bigint
+);
+
+ALTER TABLE outbox
+    ADD CONSTRAINT pk_outbox PRIMARY KEY ("event_id");
+
+ALTER TABLE outbox
+    ADD CONSTRAINT uq_outbox_table_nickname UNIQUE ("table_id", "nickname");
+
+CREATE INDEX outbox_unsent ON outbox ("event_id") WHERE "sent_ms" IS NULL;
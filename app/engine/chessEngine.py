@@ -1,8 +1,9 @@
 # Structure responsible for keeping game instance states: position, moves, etc
 
-from enum import Enum
-from typing import List, Tuple
-import copy
+import random
+from array import array
+from enum import Enum, IntEnum
+from typing import List, Optional, Tuple
 
 
 class Column(Enum):
@@ -50,20 +51,25 @@ COLUMN_LITERAL_TO_NUM = {
 }
 
 
-class PieceBoardRepr(Enum):
-    e = " "
-    p = "p"
-    n = "n"
-    b = "b"
-    r = "r"
-    q = "q"
-    k = "k"
-    P = "P"
-    N = "N"
-    B = "B"
-    R = "R"
-    Q = "Q"
-    K = "K"
+# Pieces are kept on board as small integers, so whole board fits in 64 bytes
+class PieceBoardRepr(IntEnum):
+    e = 0
+    p = 1
+    n = 2
+    b = 3
+    r = 4
+    q = 5
+    k = 6
+    P = 7
+    N = 8
+    B = 9
+    R = 10
+    Q = 11
+    K = 12
+
+
+# Symbol of piece by its value, empty square is space
+PIECE_SYMBOLS = (" ", "p", "n", "b", "r", "q", "k", "P", "N", "B", "R", "Q", "K")
 
 
 WHITE_PIECES = {
@@ -96,36 +102,40 @@ class Colors(Enum):
     black = int(1)
     neutral = int(404)
 
+
+# Color of piece by its value
+PIECE_COLORS = (Colors.neutral,) + 6 * (Colors.black,) + 6 * (Colors.white,)
+
 # CONSTANTS
 
 PIECES_NAMES_TO_SHORTCUTS = {v: k for k, v in PIECES.items()}
 START_POSITION_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR"
 
-DIAGONAL_MOVES_LIST = [[(k, k) for k in range(1, 8)], [(-k, k) for k in range(1, 8)],
-                       [(k, -k) for k in range(1, 8)], [(-k, -k) for k in range(1, 8)]]
+# Moves lists are constant tuples, so they are loaded straight from compiled module
+DIAGONAL_MOVES_LIST = (((1, 1), (2, 2), (3, 3), (4, 4), (5, 5), (6, 6), (7, 7)),
+                       ((-1, 1), (-2, 2), (-3, 3), (-4, 4), (-5, 5), (-6, 6), (-7, 7)),
+                       ((1, -1), (2, -2), (3, -3), (4, -4), (5, -5), (6, -6), (7, -7)),
+                       ((-1, -1), (-2, -2), (-3, -3), (-4, -4), (-5, -5), (-6, -6), (-7, -7)))
 
-SIDE_MOVES_LIST = [[(0, k) for k in range(1, 8)], [(0, -k) for k in range(1, 8)],
-                   [(k, 0) for k in range(1, 8)], [(-k, 0) for k in range(1, 8)]]
+SIDE_MOVES_LIST = (((0, 1), (0, 2), (0, 3), (0, 4), (0, 5), (0, 6), (0, 7)),
+                   ((0, -1), (0, -2), (0, -3), (0, -4), (0, -5), (0, -6), (0, -7)),
+                   ((1, 0), (2, 0), (3, 0), (4, 0), (5, 0), (6, 0), (7, 0)),
+                   ((-1, 0), (-2, 0), (-3, 0), (-4, 0), (-5, 0), (-6, 0), (-7, 0)))
 
-KNIGHT_MOVES_LIST = [[(1, 2)], [(1, -2)], [(-1, 2)], [(-1, -2)],
-                     [(2, 1)], [(-2, 1)], [(2, -1)], [(-2, -1)]]
+KNIGHT_MOVES_LIST = (((1, 2),), ((1, -2),), ((-1, 2),), ((-1, -2),), ((2, 1),), ((-2, 1),), ((2, -1),), ((-2, -1),))
 
 # King moves list doesn't include castling
-KING_MOVES_LIST = []
-for c in range(-1, 2):
-    for r in range(-1, 2):
-        if abs(c) + abs(r) > 0:
-            KING_MOVES_LIST.append([(c, r)])
-
-SHORT_CASTLE_MOVES_LIST = [[(1, 0), (2, 0)]]
-LONG_CASTLE_MOVES_LIST = [[(-1, 0), (-2, 0)]]
-
-WHITE_PAWN_ONE_MOVES_LIST = [[(0, 1)]]
-BLACK_PAWN_ONE_MOVES_LIST = [[(0, -1)]]
-WHITE_PAWN_TWO_MOVES_LIST = [[(0, 1), (0, 2)]]
-BLACK_PAWN_TWO_MOVES_LIST = [[(0, -1), (0, -2)]]
-WHITE_PAWN_TAKES_MOVES_LIST = [[(1, 1)], [(-1, 1)]]
-BLACK_PAWN_TAKES_MOVES_LIST = [[(1, -1)], [(-1, -1)]]
+KING_MOVES_LIST = (((-1, -1),), ((-1, 0),), ((-1, 1),), ((0, -1),), ((0, 1),), ((1, -1),), ((1, 0),), ((1, 1),))
+
+SHORT_CASTLE_MOVES_LIST = (((1, 0), (2, 0)),)
+LONG_CASTLE_MOVES_LIST = (((-1, 0), (-2, 0)),)
+
+WHITE_PAWN_ONE_MOVES_LIST = (((0, 1),),)
+BLACK_PAWN_ONE_MOVES_LIST = (((0, -1),),)
+WHITE_PAWN_TWO_MOVES_LIST = (((0, 1), (0, 2)),)
+BLACK_PAWN_TWO_MOVES_LIST = (((0, -1), (0, -2)),)
+WHITE_PAWN_TAKES_MOVES_LIST = (((1, 1),), ((-1, 1),))
+BLACK_PAWN_TAKES_MOVES_LIST = (((1, -1),), ((-1, -1),))
 # special moves that need extra check (castle, pawn 2 fields, pawn takes, en passant, promotion)
 
 MOVE_NOT_FOUND = -1
@@ -139,6 +149,165 @@ BLACK_KING_AFTER_SHORT_CASTLE_POSITION = (6, 7)
 WHITE_KING_AFTER_LONG_CASTLE_POSITION = (2, 0)
 BLACK_KING_AFTER_LONG_CASTLE_POSITION = (2, 7)
 
+# Draw rules
+FIFTY_MOVES_RULE_HALF_MOVES = 100
+REPETITIONS_TO_DRAW = 3
+# Pieces whose presence always leaves enough material to mate
+MATING_PIECES = (1, 4, 5, 7, 10, 11)
+
+# Zobrist keys of position. Generator is seeded, so hashes stored in database stay valid in every process.
+# Keys have 63 bits to fit into signed bigint.
+ZOBRIST_RANDOM = random.Random(20210601)
+# Indexed by piece * 64 + square, empty square has zero keys
+ZOBRIST_PIECES = (0,) * 64 + tuple(ZOBRIST_RANDOM.getrandbits(63) for _ in range(12 * 64))
+ZOBRIST_BLACK_TO_MOVE = ZOBRIST_RANDOM.getrandbits(63)
+# White short, white long, black short, black long
+ZOBRIST_CASTLES = tuple(ZOBRIST_RANDOM.getrandbits(63) for _ in range(4))
+ZOBRIST_EN_PASSANT_COLUMNS = tuple(ZOBRIST_RANDOM.getrandbits(63) for _ in range(8))
+
+# Packed move fits in 16 bits: end square in bits 0-5, start square in bits 6-11, flags in bits 12-15.
+# Squares are numbered like board, column * 8 + row.
+MOVE_SQUARE_MASK = 0x3F
+MOVE_START_SHIFT = 6
+MOVE_FLAGS_SHIFT = 12
+# Flags mark promotion, engine always promotes to queen
+MOVE_FLAG_NONE = 0
+MOVE_FLAG_PROMOTION_QUEEN = 4
+# Only promotion suffix of long algebraic notation the engine can play
+PROMOTION_QUEEN_LITERAL = 'q'
+# Digits allowed in move string
+MOVE_STRING_DIGITS = '01234567'
+
+
+# Squares seen from every square, nearest first. Lines are cut at the edge of the board.
+def get_rays(directions) -> tuple:
+    rays = []
+    for square in range(64):
+        square_rays = []
+        for col_step, row_step in directions:
+            col, row = square >> 3, square & 7
+            ray = []
+            while 0 <= col + col_step < 8 and 0 <= row + row_step < 8:
+                col += col_step
+                row += row_step
+                ray.append(col * 8 + row)
+            square_rays.append(tuple(ray))
+        rays.append(tuple(square_rays))
+    return tuple(rays)
+
+
+# Squares reached by one step of each moves list, from every square
+def get_jumps(moves_lists) -> tuple:
+    jumps = []
+    for square in range(64):
+        square_jumps = []
+        for move_list in moves_lists:
+            col, row = (square >> 3) + move_list[0][0], (square & 7) + move_list[0][1]
+            if 0 <= col < 8 and 0 <= row < 8:
+                square_jumps.append(col * 8 + row)
+        jumps.append(tuple(square_jumps))
+    return tuple(jumps)
+
+
+LINE_DIRECTIONS = [move_list[0] for move_list in SIDE_MOVES_LIST + DIAGONAL_MOVES_LIST]
+# Index of direction pointing back
+OPPOSITE_DIRECTIONS = tuple(LINE_DIRECTIONS.index((-col_step, -row_step)) for col_step, row_step in LINE_DIRECTIONS)
+# Four side rays followed by four diagonal ones
+LINE_RAYS = get_rays(LINE_DIRECTIONS)
+SIDE_RAYS = tuple(rays[:4] for rays in LINE_RAYS)
+DIAGONAL_RAYS = tuple(rays[4:] for rays in LINE_RAYS)
+KNIGHT_JUMPS = get_jumps(KNIGHT_MOVES_LIST)
+KING_JUMPS = get_jumps(KING_MOVES_LIST)
+# Squares from which pawn of given color attacks the square, indexed by color value and square
+PAWN_ATTACKERS_JUMPS = (get_jumps(BLACK_PAWN_TAKES_MOVES_LIST), get_jumps(WHITE_PAWN_TAKES_MOVES_LIST))
+# Squares attacked by pawn of given color standing on the square
+PAWN_ATTACKS_JUMPS = (get_jumps(WHITE_PAWN_TAKES_MOVES_LIST), get_jumps(BLACK_PAWN_TAKES_MOVES_LIST))
+
+# Pieces moving along lines of each kind
+SIDE_SLIDERS = frozenset((PieceBoardRepr.R, PieceBoardRepr.r, PieceBoardRepr.Q, PieceBoardRepr.q))
+DIAGONAL_SLIDERS = frozenset((PieceBoardRepr.B, PieceBoardRepr.b, PieceBoardRepr.Q, PieceBoardRepr.q))
+# Sliders moving in each of LINE_DIRECTIONS
+LINE_SLIDERS = 4 * (SIDE_SLIDERS,) + 4 * (DIAGONAL_SLIDERS,)
+
+# Pieces of color, indexed by color value: pawn, knight, bishop, rook, queen, king
+COLOR_PIECES = ((PieceBoardRepr.P, PieceBoardRepr.N, PieceBoardRepr.B, PieceBoardRepr.R, PieceBoardRepr.Q,
+                 PieceBoardRepr.K),
+                (PieceBoardRepr.p, PieceBoardRepr.n, PieceBoardRepr.b, PieceBoardRepr.r, PieceBoardRepr.q,
+                 PieceBoardRepr.k))
+
+
+# Board is a bytearray of 64 squares, column after column
+def cord_to_square(cord: (int, int)) -> int:
+    return cord[0] * 8 + cord[1]
+
+
+def square_to_cord(square: int) -> (int, int):
+    return square >> 3, square & 7
+
+
+def encode_move(start: (int, int), end: (int, int), flags: int = MOVE_FLAG_NONE) -> int:
+    return flags << MOVE_FLAGS_SHIFT | (start[0] * 8 + start[1]) << MOVE_START_SHIFT | end[0] * 8 + end[1]
+
+
+def get_move_start(move: int) -> (int, int):
+    return square_to_cord(move >> MOVE_START_SHIFT & MOVE_SQUARE_MASK)
+
+
+def get_move_end(move: int) -> (int, int):
+    return square_to_cord(move & MOVE_SQUARE_MASK)
+
+
+def get_move_flags(move: int) -> int:
+    return move >> MOVE_FLAGS_SHIFT
+
+
+def decode_move(move: int) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    return get_move_start(move), get_move_end(move)
+
+
+# Move lists are arrays of unsigned 16-bit moves, two bytes per move instead of two tuples
+def get_empty_move_list() -> array:
+    return array('H')
+
+
+# Move string is 4 digits [0-7]: start column, start row, end column, end row. Returns None when it is malformed
+def move_string_to_move(move_string: str) -> Optional[int]:
+    if len(move_string) != 4:
+        return None
+    for digit in move_string:
+        if digit not in MOVE_STRING_DIGITS:
+            return None
+    return encode_move((ord(move_string[0]) - 48, ord(move_string[1]) - 48),
+                       (ord(move_string[2]) - 48, ord(move_string[3]) - 48))
+
+
+def move_to_move_string(move: int) -> str:
+    start, end = decode_move(move)
+    return '%d%d%d%d' % (start[0], start[1], end[0], end[1])
+
+
+# Accepts long algebraic notation like e2e4 or e7e8q, returns None when it is malformed or promotes
+# to anything but queen, which the engine would silently turn into queen
+def uci_to_move(uci: str) -> Optional[int]:
+    if len(uci) not in (4, 5):
+        return None
+    flags = MOVE_FLAG_NONE
+    if len(uci) == 5:
+        if uci[4] != PROMOTION_QUEEN_LITERAL:
+            return None
+        flags = MOVE_FLAG_PROMOTION_QUEEN
+    if uci[0] not in COLUMN_LITERAL_TO_NUM or uci[2] not in COLUMN_LITERAL_TO_NUM \
+            or uci[1] not in '12345678' or uci[3] not in '12345678':
+        return None
+    return encode_move((COLUMN_LITERAL_TO_NUM[uci[0]], int(uci[1]) - 1),
+                       (COLUMN_LITERAL_TO_NUM[uci[2]], int(uci[3]) - 1), flags)
+
+
+def move_to_uci(move: int) -> str:
+    start, end = decode_move(move)
+    uci = board_coordinates_to_literal(start) + board_coordinates_to_literal(end)
+    return uci + PROMOTION_QUEEN_LITERAL if get_move_flags(move) == MOVE_FLAG_PROMOTION_QUEEN else uci
+
 
 def get_id_of_move_in_moves_list(diff: (int, int), moves_list) -> int:
     pos = MOVE_NOT_FOUND
@@ -154,7 +323,7 @@ def check_legality_on_moves_list(start: (int, int), pos: int, move_diff_list, bo
     for i in range(pos):
         new_col = start[0] + move_diff_list[i][0]
         new_row = start[1] + move_diff_list[i][1]
-        piece_on_new_field = board[new_col][new_row]
+        piece_on_new_field = board[new_col * 8 + new_row]
         if piece_on_new_field != PieceBoardRepr.e:
             is_move_on_list = False
             break
@@ -195,12 +364,7 @@ def is_king(piece):
 
 
 def get_color_of_piece(piece) -> Colors:
-    if piece.name in BLACK_PIECES:
-        return Colors.black
-    elif piece.name in WHITE_PIECES:
-        return Colors.white
-    else:
-        return Colors.neutral
+    return PIECE_COLORS[piece]
 
 
 # Checks whether during the move we are not trying to capture our own piece
@@ -239,7 +403,7 @@ def is_square_under_attack(cord: (int, int), board, square_owner_color: Colors)
             if not is_square_on_board((new_col, new_row)):
                 break
 
-            piece = board[new_col][new_row]
+            piece = board[new_col * 8 + new_row]
             piece_color = get_color_of_piece(piece)
 
             if piece_color == square_owner_color:
@@ -260,7 +424,7 @@ def is_square_under_attack(cord: (int, int), board, square_owner_color: Colors)
             if not is_square_on_board((new_col, new_row)):
                 break
 
-            piece = board[new_col][new_row]
+            piece = board[new_col * 8 + new_row]
             piece_color = get_color_of_piece(piece)
 
             if piece_color == square_owner_color:
@@ -284,7 +448,7 @@ def is_square_under_attack(cord: (int, int), board, square_owner_color: Colors)
             if not is_square_on_board((new_col, new_row)):
                 break
 
-            piece = board[new_col][new_row]
+            piece = board[new_col * 8 + new_row]
             piece_color = get_color_of_piece(piece)
 
             if piece_color == square_owner_color:
@@ -304,38 +468,8 @@ def literal_to_board_coordinates(literal: str) -> Tuple[int, int]:
     return COLUMN_LITERAL_TO_NUM[literal[0]], int(literal[1]) - 1
 
 
-def get_copy_of_modified_board_after_cord_changes(changes: List[Tuple[Tuple[int, int], PieceBoardRepr]], board):
-    new_board = copy.deepcopy(board)
-    for change in changes:
-        cord = change[0]
-        piece = change[1]
-        new_board[cord[0]][cord[1]] = copy.deepcopy(piece)
-    return new_board
-
-
-def get_copy_of_modified_board_after_literal_changes(changes: List[Tuple[str, PieceBoardRepr]], board):
-    new_board = copy.deepcopy(board)
-    for change in changes:
-        literal_cord = change[0]
-        piece = change[1]
-        cord = literal_to_board_coordinates(literal_cord)
-        new_board[cord[0]][cord[1]] = piece
-    return new_board
-
-
 def get_piece_repr_from_board_cord(cords: (int, int), board) -> PieceBoardRepr:
-    return board[cords[0]][cords[1]]
-
-
-def get_piece_repr_from_board_literal(literal: str, board) -> PieceBoardRepr:
-    cords = literal_to_board_coordinates(literal)
-    return get_piece_repr_from_board_cord(cords, board)
-
-
-def get_copy_of_modified_board_after_move_literal(start: str, end: str, board):
-    piece_moving = get_piece_repr_from_board_literal(start, board)
-    change_list = [(start, PieceBoardRepr.e), (end, piece_moving)]
-    return get_copy_of_modified_board_after_literal_changes(change_list, board)
+    return board[cords[0] * 8 + cords[1]]
 
 
 def is_promotion(end: (int, int), piece_moving: PieceBoardRepr):
@@ -346,57 +480,219 @@ def is_promotion(end: (int, int), piece_moving: PieceBoardRepr):
     return False
 
 
-def get_copy_of_modified_board_after_move_cords(start: (int, int), end: (int, int), board):
+# Returns list of (square, piece) changes moving piece from start to end makes on board
+def get_move_changes(start: (int, int), end: (int, int), board) -> List[Tuple[int, PieceBoardRepr]]:
     piece_moving = get_piece_repr_from_board_cord(start, board)
-    change_list = [(start, PieceBoardRepr.e)]
-    new_board = copy.deepcopy(board)
 
     if is_promotion(end, piece_moving):
         if get_color_of_piece(piece_moving) == Colors.white:
-            change_list.append((end, PieceBoardRepr.Q))
+            piece_moving = PieceBoardRepr.Q
         elif get_color_of_piece(piece_moving) == Colors.black:
-            change_list.append((end, PieceBoardRepr.q))
-    else:
-        change_list.append((end, piece_moving))
+            piece_moving = PieceBoardRepr.q
 
-    return get_copy_of_modified_board_after_cord_changes(change_list, new_board)
+    return [(cord_to_square(start), PieceBoardRepr.e), (cord_to_square(end), piece_moving)]
+
+
+# Modifies board in place, returns changes that revert it
+def apply_changes(changes: List[Tuple[int, PieceBoardRepr]], board) -> List[Tuple[int, PieceBoardRepr]]:
+    previous = [(square, board[square]) for square, _ in changes]
+    for square, piece in changes:
+        board[square] = piece
+    return previous
+
+
+def revert_changes(previous: List[Tuple[int, PieceBoardRepr]], board):
+    for square, piece in reversed(previous):
+        board[square] = piece
+
+
+def get_castles_hash(legal_white_short_castle, legal_white_long_castle, legal_black_short_castle,
+                     legal_black_long_castle) -> int:
+    castles_hash = 0
+    for key, legal in zip(ZOBRIST_CASTLES, (legal_white_short_castle, legal_white_long_castle,
+                                            legal_black_short_castle, legal_black_long_castle)):
+        if legal:
+            castles_hash ^= key
+    return castles_hash
+
+
+def get_en_passant_hash(en_passant) -> int:
+    if en_passant == ILLEGAL_EN_PASSANT:
+        return 0
+    return ZOBRIST_EN_PASSANT_COLUMNS[en_passant[0]]
 
 
 def get_king_cords_by_color(board, color: Colors) -> (int, int):
     if color == Colors.neutral:
         raise ValueError("Error while trying to find king position, King can be either black or white")
 
-    for col in range(8):
-        for row in range(8):
-            piece = board[col][row]
-            if is_king(piece) and get_color_of_piece(piece) == color:
-                return col, row
-
-    raise Exception("Unable to find king on board")
+    king = PieceBoardRepr.K if color == Colors.white else PieceBoardRepr.k
+    square = board.find(king)
+    if square == -1:
+        raise Exception("Unable to find king on board")
+    return divmod(square, 8)
+
+
+# Squares attacked by piece standing on the square, slider lines end on the first piece they hit
+def get_piece_attacks(board, square: int, piece: PieceBoardRepr):
+    if is_pawn(piece):
+        return PAWN_ATTACKS_JUMPS[PIECE_COLORS[piece].value][square]
+    if is_knight(piece):
+        return KNIGHT_JUMPS[square]
+    if is_king(piece):
+        return KING_JUMPS[square]
+    rays = ()
+    if piece in SIDE_SLIDERS:
+        rays += SIDE_RAYS[square]
+    if piece in DIAGONAL_SLIDERS:
+        rays += DIAGONAL_RAYS[square]
+    attacks = []
+    for ray in rays:
+        for target in ray:
+            attacks.append(target)
+            if board[target] != PieceBoardRepr.e:
+                break
+    return attacks
+
+
+# Lines of other sliders reaching any of the squares, as (slider square, direction). Only these lines
+# change when pieces on the squares do.
+def get_lines_through_squares(board, squares) -> set:
+    lines = set()
+    for square in squares:
+        for direction, ray in enumerate(LINE_RAYS[square]):
+            for target in ray:
+                piece = board[target]
+                if piece != PieceBoardRepr.e:
+                    if piece in LINE_SLIDERS[direction] and target not in squares:
+                        lines.add((target, OPPOSITE_DIRECTIONS[direction]))
+                    break
+    return lines
+
+
+# Counts of pieces attacking each square, indexed by color value * 64 + square
+def get_attack_maps(board) -> bytearray:
+    attack_maps = bytearray(128)
+    for square, piece in enumerate(board):
+        if piece != PieceBoardRepr.e:
+            offset = PIECE_COLORS[piece].value * 64
+            for target in get_piece_attacks(board, square, piece):
+                attack_maps[offset + target] += 1
+    return attack_maps
+
+
+# Pieces giving check to king of one color and pieces pinned to it. Move is then legal for the king when
+# it doesn't end on attacked square, and for other pieces when it stays on the pin ray and, in check,
+# captures or blocks the only checker.
+class KingSafety:
+    __slots__ = ('king_square', 'checkers', 'check_blocks', 'pin_rays', 'behind_king')
+
+    def __init__(self, king_square: int, checkers: List[int], check_blocks: Optional[set], pin_rays: dict,
+                 behind_king: set):
+        self.king_square = king_square
+        self.checkers = checkers
+        # Squares where a piece captures or blocks the checker, None when king is not in check
+        self.check_blocks = check_blocks
+        # Pinned square -> squares it may move to: between king and pinner, and the pinner
+        self.pin_rays = pin_rays
+        # Squares behind the king on lines of checking sliders. Attack maps see the king as blocker,
+        # but the line goes on once king steps back along it.
+        self.behind_king = behind_king
+
+
+def get_king_safety(board, color: Colors) -> KingSafety:
+    king_cords = get_king_cords_by_color(board, color)
+    king_square = cord_to_square(king_cords)
+    opponent = Colors.black if color == Colors.white else Colors.white
+    pawn, knight, bishop, rook, queen, king = COLOR_PIECES[opponent.value]
+
+    checkers = []
+    check_blocks = set()
+    pin_rays = {}
+    behind_king = set()
+    for rays, line_piece in ((SIDE_RAYS[king_square], rook), (DIAGONAL_RAYS[king_square], bishop)):
+        for ray in rays:
+            pinned_square = None
+            for index, target in enumerate(ray):
+                piece = board[target]
+                if piece == PieceBoardRepr.e:
+                    continue
+                if PIECE_COLORS[piece] == color:
+                    if pinned_square is not None:
+                        break
+                    pinned_square = target
+                    continue
+                if piece == line_piece or piece == queen:
+                    if pinned_square is None:
+                        checkers.append(target)
+                        check_blocks.update(ray[:index + 1])
+                        behind_cord = (2 * king_cords[0] - (ray[0] >> 3), 2 * king_cords[1] - (ray[0] & 7))
+                        if is_square_on_board(behind_cord):
+                            behind_king.add(cord_to_square(behind_cord))
+                    else:
+                        pin_rays[pinned_square] = set(ray[:index + 1])
+                break
 
+    for square in KNIGHT_JUMPS[king_square]:
+        if board[square] == knight:
+            checkers.append(square)
+            check_blocks.add(square)
+    for square in PAWN_ATTACKERS_JUMPS[opponent.value][king_square]:
+        if board[square] == pawn:
+            checkers.append(square)
+            check_blocks.add(square)
 
-def will_our_king_be_in_check_after_move(start: (int, int), end: (int, int), board, color: Colors) -> bool:
-    board_after_move = get_copy_of_modified_board_after_move_cords(start, end, board)
-    king_cords = get_king_cords_by_color(board_after_move, color)
-    return is_square_under_attack(king_cords, board_after_move, color)
+    return KingSafety(king_square, checkers, check_blocks if checkers else None, pin_rays, behind_king)
 
 
+# Describes legal move: changes it makes on board and game state after it
 class ResponseGameState:
-    def __init__(self, board, legal_white_short_castle, legal_white_long_castle,
+    __slots__ = ('changes', 'legal_white_short_castle', 'legal_white_long_castle', 'legal_black_short_castle',
+                 'legal_black_long_castle', 'en_passant', 'half_moves_since_capture')
+
+    def __init__(self, changes, legal_white_short_castle, legal_white_long_castle,
                  legal_black_short_castle, legal_black_long_castle, en_passant,
                  half_moves_since_capture):
-        self.board = board
+        self.changes = changes
+        self.legal_white_short_castle = legal_white_short_castle
+        self.legal_white_long_castle = legal_white_long_castle
+        self.legal_black_short_castle = legal_black_short_castle
+        self.legal_black_long_castle = legal_black_long_castle
+        self.en_passant = en_passant
+        self.half_moves_since_capture = half_moves_since_capture
+
+
+# Everything needed to take back a move: previous pieces on changed squares and previous game state
+class UndoRecord:
+    __slots__ = ('changes', 'color_to_move', 'legal_white_short_castle', 'legal_white_long_castle',
+                 'legal_black_short_castle', 'legal_black_long_castle', 'en_passant', 'half_moves_since_capture',
+                 'full_moves', 'position_hash')
+
+    def __init__(self, changes, color_to_move, legal_white_short_castle, legal_white_long_castle,
+                 legal_black_short_castle, legal_black_long_castle, en_passant, half_moves_since_capture,
+                 full_moves, position_hash):
+        self.changes = changes
+        self.color_to_move = color_to_move
         self.legal_white_short_castle = legal_white_short_castle
         self.legal_white_long_castle = legal_white_long_castle
         self.legal_black_short_castle = legal_black_short_castle
         self.legal_black_long_castle = legal_black_long_castle
         self.en_passant = en_passant
         self.half_moves_since_capture = half_moves_since_capture
+        self.full_moves = full_moves
+        self.position_hash = position_hash
 
 
 class GameState:
+    __slots__ = ('board', 'color_to_move', 'legal_white_short_castle', 'legal_white_long_castle',
+                 'legal_black_short_castle', 'legal_black_long_castle', 'en_passant', 'half_moves_since_capture',
+                 'full_moves', 'position_hash', 'position_hashes', 'piece_counts', 'attack_maps',
+                 'king_safety')
+
     def __init__(self):
         self.board = self.get_starting_position()
+        # Color -> KingSafety of the current board, dropped whenever board changes
+        self.king_safety = None
         self.color_to_move = Colors.white
         self.legal_white_short_castle = True
         self.legal_white_long_castle = True
@@ -405,9 +701,33 @@ class GameState:
         self.en_passant = ILLEGAL_EN_PASSANT
         self.half_moves_since_capture = 0
         self.full_moves = 1
+        self.reset_position_tracking()
+
+    # Recomputes from scratch what make_move updates incrementally: hash, number of pieces of each kind
+    # and attack maps. History of positions starts with the current one.
+    def reset_position_tracking(self):
+        self.attack_maps = get_attack_maps(self.board)
+        self.piece_counts = bytearray(13)
+        position_hash = 0
+        for square, piece in enumerate(self.board):
+            self.piece_counts[piece] += 1
+            position_hash ^= ZOBRIST_PIECES[piece * 64 + square]
+        if self.color_to_move == Colors.black:
+            position_hash ^= ZOBRIST_BLACK_TO_MOVE
+        position_hash ^= get_castles_hash(self.legal_white_short_castle, self.legal_white_long_castle,
+                                          self.legal_black_short_castle, self.legal_black_long_castle)
+        position_hash ^= get_en_passant_hash(self.en_passant)
+        self.position_hash = position_hash
+        self.position_hashes = [position_hash]
+
+    # Restores history saved with the position, ignored when it doesn't end with the current position
+    def load_position_hashes(self, position_hashes: List[int]):
+        if position_hashes and position_hashes[-1] == self.position_hash:
+            self.position_hashes = list(position_hashes)
 
     def load_position_from_fen(self, fen: str):
         self.board = self.get_board_from_fen(fen)
+        self.king_safety = None
 
     # We assume that fen is correct
     def load_game_state_from_fen(self, fen: str):
@@ -423,14 +743,10 @@ class GameState:
 
         self.load_position_from_fen(fen_board)
 
-        if 'Q' in fen_possible_castles:
-            self.legal_white_long_castle = True
-        if 'K' in fen_possible_castles:
-            self.legal_white_short_castle = True
-        if 'q' in fen_possible_castles:
-            self.legal_black_long_castle = True
-        if 'k' in fen_possible_castles:
-            self.legal_black_short_castle = True
+        self.legal_white_long_castle = 'Q' in fen_possible_castles
+        self.legal_white_short_castle = 'K' in fen_possible_castles
+        self.legal_black_long_castle = 'q' in fen_possible_castles
+        self.legal_black_short_castle = 'k' in fen_possible_castles
 
         if fen_enpassant != '-':
             self.en_passant = literal_to_board_coordinates(fen_enpassant)
@@ -439,6 +755,7 @@ class GameState:
 
         self.half_moves_since_capture = int(fen_half_move_clock)
         self.full_moves = int(fen_full_move_number)
+        self.reset_position_tracking()
         return
 
     def position_to_fen(self):
@@ -453,7 +770,7 @@ class GameState:
                     if how_many_empty > 0:
                         fen += str(how_many_empty)
                         how_many_empty = 0
-                    fen += piece.name
+                    fen += PIECE_SYMBOLS[piece]
             if how_many_empty > 0:
                 fen += str(how_many_empty)
             if row < 7:
@@ -506,10 +823,10 @@ class GameState:
     def is_castle(self, start: (int, int), end: (int, int), piece_color: Colors) -> bool:
         is_move_on_list = False
         start_end_diff = (end[0] - start[0], end[1] - start[1])
-        is_king_in_check = is_square_under_attack(start, self.board, piece_color)
 
-        # We can't castle while being in check
-        if is_king_in_check:
+        # We can't castle while being in check, nor through attacked square
+        if self.is_square_attacked(start, piece_color) \
+                or self.is_square_attacked(((start[0] + end[0]) // 2, start[1]), piece_color):
             return False
 
         # Check whether move is short castle
@@ -521,11 +838,11 @@ class GameState:
 
         if is_move_on_list:
             if piece_color == Colors.white and self.legal_white_short_castle:
-                return self.board[6][0] == PieceBoardRepr.e and self.board[5][0] == PieceBoardRepr.e \
-                       and self.board[7][0] == PieceBoardRepr.R
+                return self.get_piece_from_board((6, 0)) == PieceBoardRepr.e and self.get_piece_from_board((5, 0)) == PieceBoardRepr.e \
+                       and self.get_piece_from_board((7, 0)) == PieceBoardRepr.R
             elif piece_color == Colors.black and self.legal_black_short_castle:
-                return self.board[6][7] == PieceBoardRepr.e and self.board[5][7] == PieceBoardRepr.e \
-                       and self.board[7][7] == PieceBoardRepr.r
+                return self.get_piece_from_board((6, 7)) == PieceBoardRepr.e and self.get_piece_from_board((5, 7)) == PieceBoardRepr.e \
+                       and self.get_piece_from_board((7, 7)) == PieceBoardRepr.r
             return False
 
         # Check whether move is long castle
@@ -537,77 +854,124 @@ class GameState:
 
         if is_move_on_list:
             if piece_color == Colors.white and self.legal_white_long_castle:
-                return self.board[1][0] == PieceBoardRepr.e and self.board[2][0] == PieceBoardRepr.e \
-                       and self.board[3][0] == PieceBoardRepr.e and self.board[0][0] == PieceBoardRepr.R
+                return self.get_piece_from_board((1, 0)) == PieceBoardRepr.e and self.get_piece_from_board((2, 0)) == PieceBoardRepr.e \
+                       and self.get_piece_from_board((3, 0)) == PieceBoardRepr.e and self.get_piece_from_board((0, 0)) == PieceBoardRepr.R
             elif piece_color == Colors.black and self.legal_black_long_castle:
-                return self.board[1][7] == PieceBoardRepr.e and self.board[2][7] == PieceBoardRepr.e \
-                       and self.board[3][7] == PieceBoardRepr.e and self.board[0][7] == PieceBoardRepr.r
+                return self.get_piece_from_board((1, 7)) == PieceBoardRepr.e and self.get_piece_from_board((2, 7)) == PieceBoardRepr.e \
+                       and self.get_piece_from_board((3, 7)) == PieceBoardRepr.e and self.get_piece_from_board((0, 7)) == PieceBoardRepr.r
         return False
 
     def is_field_free(self, pos: (int, int)) -> bool:
-        return self.board[pos[0]][pos[1]] == PieceBoardRepr.e
+        return self.board[pos[0] * 8 + pos[1]] == PieceBoardRepr.e
 
     def pawn_two_steps_legal(self, start: (int, int), end: (int, int), pawn_start_row: int) -> bool:
         return pawn_start_row == start[1] and self.is_field_free(end)
 
     def get_piece_from_board(self, position: (int, int)):
-        return self.board[position[0]][position[1]]
+        return self.board[position[0] * 8 + position[1]]
 
     def get_players_squares_list(self, color: Colors):
         list_of_players_squares = []
         for col in range(8):
             for row in range(8):
-                piece = self.board[col][row]
+                piece = self.board[col * 8 + row]
                 if get_color_of_piece(piece) == color:
                     list_of_players_squares.append((col, row))
         return list_of_players_squares
 
     def is_stale_mated(self, color: Colors) -> bool:
         kings_cords = get_king_cords_by_color(self.board, color)
-        under_check = is_square_under_attack(kings_cords, self.board, color)
+        under_check = self.is_square_attacked(kings_cords, color)
 
         # If king is not under attack can't be mated
         if under_check:
             return False
 
-        list_of_players_squares = self.get_players_squares_list(color)
-
-        for square in list_of_players_squares:
-            for col in range(8):
-                for row in range(8):
-                    target_square = (col, row)
-                    if self.is_move_legal(square, target_square, True)[0] is True:
-                        return False
+        if self.has_legal_move(color):
+            return False
         print("Player is stalemated", color.name)
         return True
 
     def is_mated(self, color: Colors) -> bool:
         kings_cords = get_king_cords_by_color(self.board, color)
-        under_check = is_square_under_attack(kings_cords, self.board, color)
+        under_check = self.is_square_attacked(kings_cords, color)
 
         # If king is not under attack can't be mated
         if not under_check:
             return False
 
-        list_of_players_squares = self.get_players_squares_list(color)
+        if self.has_legal_move(color):
+            return False
+        print("Player is mated", color.name)
+        return True
+
+    def has_legal_move(self, color: Colors) -> bool:
+        for square in self.get_players_squares_list(color):
+            for col in range(8):
+                for row in range(8):
+                    if self.is_move_legal(square, (col, row), ignore_color=True)[0] is True:
+                        return True
+        return False
 
-        for square in list_of_players_squares:
+    # Returns packed legal moves of color, promotions are flagged
+    def get_legal_moves(self, color: Colors) -> array:
+        moves = get_empty_move_list()
+        for square in self.get_players_squares_list(color):
+            piece = self.get_piece_from_board(square)
             for col in range(8):
                 for row in range(8):
                     target_square = (col, row)
                     if self.is_move_legal(square, target_square, ignore_color=True)[0] is True:
-                        return False
-        print("Player is mated", color.name)
-        return True
+                        flags = MOVE_FLAG_PROMOTION_QUEEN if is_promotion(target_square, piece) else MOVE_FLAG_NONE
+                        moves.append(encode_move(square, target_square, flags))
+        return moves
+
+    # Looked up in attack maps: whether any opponent's piece attacks square owned by color
+    def is_square_attacked(self, cord: (int, int), square_owner_color: Colors) -> bool:
+        return self.attack_maps[(1 - square_owner_color.value) * 64 + cord[0] * 8 + cord[1]] > 0
+
+    def get_king_safety(self, color: Colors) -> KingSafety:
+        if self.king_safety is None:
+            self.king_safety = {}
+        king_safety = self.king_safety.get(color)
+        if king_safety is None:
+            king_safety = get_king_safety(self.board, color)
+            self.king_safety[color] = king_safety
+        return king_safety
+
+    # Decided from checkers and pins of the position, board is not touched except for en passant
+    def is_king_safe_after_move(self, start: (int, int), end: (int, int), piece: PieceBoardRepr,
+                                color: Colors) -> bool:
+        king_safety = self.get_king_safety(color)
+        start_square = cord_to_square(start)
+        end_square = cord_to_square(end)
+        if start_square == king_safety.king_square:
+            return not self.is_square_attacked(end, color) and end_square not in king_safety.behind_king
+
+        # En passant removes two pawns from one row, which no pin describes, so it is played on the board
+        if is_pawn(piece) and end == self.en_passant and start[0] != end[0]:
+            previous = apply_changes([(start_square, PieceBoardRepr.e), (end_square, piece),
+                                      (cord_to_square((end[0], start[1])), PieceBoardRepr.e)], self.board)
+            try:
+                return not is_square_under_attack(square_to_cord(king_safety.king_square), self.board, color)
+            finally:
+                revert_changes(previous, self.board)
+
+        if len(king_safety.checkers) > 1:
+            return False
+        pin_ray = king_safety.pin_rays.get(start_square)
+        if pin_ray is not None and end_square not in pin_ray:
+            return False
+        return king_safety.check_blocks is None or end_square in king_safety.check_blocks
 
     def is_move_legal(self, start: (int, int), end: (int, int), ignore_color=False) -> Tuple:
-        piece = self.board[start[0]][start[1]]
-        piece_color = get_color_of_piece(piece)
-
         # Check whether start and end are on board
         if not is_square_on_board(start) or not is_square_on_board(end):
             return False, None
 
+        piece = self.get_piece_from_board(start)
+        piece_color = get_color_of_piece(piece)
+
         # Check whether start and end field are distinct cause such move is illegal
         if start == end:
             return False, None
@@ -618,10 +982,10 @@ class GameState:
                 return False, None
 
         # Check whether piece on target square is opposite's color or square is empty
-        if not validate_capturing_our_own_piece(piece, self.board[end[0]][end[1]]):
+        if not validate_capturing_our_own_piece(piece, self.get_piece_from_board(end)):
             return False, None
 
-        if will_our_king_be_in_check_after_move(start, end, self.board, piece_color):
+        if not self.is_king_safe_after_move(start, end, piece, piece_color):
             return False, None
 
         # Recognize piece
@@ -651,11 +1015,10 @@ class GameState:
                     break
             if is_move_on_list:
                 if self.is_field_free(end):
-                    new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
-                    return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                    changes = get_move_changes(start, end, self.board)
+                    return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                    self.legal_white_long_castle, self.legal_black_short_castle,
-                                                   self.legal_black_long_castle, ILLEGAL_EN_PASSANT,
-                                                   self.half_moves_since_capture + 1)
+                                                   self.legal_black_long_castle, ILLEGAL_EN_PASSANT, 0)
                 return False, None
 
             # Check two steps pawn move
@@ -666,11 +1029,11 @@ class GameState:
                     break
             if is_move_on_list:
                 if self.pawn_two_steps_legal(start, end, pawn_start_row):
-                    new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
-                    return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                    changes = get_move_changes(start, end, self.board)
+                    return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                    self.legal_white_long_castle, self.legal_black_short_castle,
                                                    self.legal_black_long_castle, (start[0], (start[1] + end[1]) // 2),
-                                                   self.half_moves_since_capture + 1)
+                                                   0)
                 return False, None
 
             # Check pawn takes and enpassant
@@ -680,11 +1043,11 @@ class GameState:
                     is_move_on_list = check_legality_on_moves_list(start, pos, move_diff_list, self.board)
                     break
             if is_move_on_list:
-                piece_start = self.board[start[0]][start[1]]
-                piece_end = self.board[end[0]][end[1]]
+                piece_start = self.get_piece_from_board(start)
+                piece_end = self.get_piece_from_board(end)
                 if is_capturing_opposite_piece(piece_start, piece_end):
-                    new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
-                    return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                    changes = get_move_changes(start, end, self.board)
+                    return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                    self.legal_white_long_castle, self.legal_black_short_castle,
                                                    self.legal_black_long_castle, ILLEGAL_EN_PASSANT, 0)
                 else:
@@ -696,12 +1059,9 @@ class GameState:
                     if is_capturing_opposite_piece(piece_start, enpassant_piece) \
                             and self.is_field_free(end) and is_pawn(enpassant_piece) \
                             and self.en_passant == end:
-                        tmp_new_board = get_copy_of_modified_board_after_move_cords(start,
-                                                                                    enpassant_opponents_pawn_position,
-                                                                                    self.board)
-                        new_board = get_copy_of_modified_board_after_move_cords(enpassant_opponents_pawn_position,
-                                                                                end, tmp_new_board)
-                        return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                        changes = get_move_changes(start, end, self.board)
+                        changes.append((cord_to_square(enpassant_opponents_pawn_position), PieceBoardRepr.e))
+                        return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                        self.legal_white_long_castle, self.legal_black_short_castle,
                                                        self.legal_black_long_castle, ILLEGAL_EN_PASSANT, 0)
                     return False, None
@@ -719,14 +1079,14 @@ class GameState:
                     break
 
             if is_move_on_list:
-                new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
+                changes = get_move_changes(start, end, self.board)
                 lwsc = False if start == (7, 0) else self.legal_white_short_castle
                 lwlc = False if start == (0, 0) else self.legal_white_long_castle
                 lbsc = False if start == (7, 7) else self.legal_black_short_castle
                 lblc = False if start == (0, 7) else self.legal_black_long_castle
                 piece_at_end = get_piece_repr_from_board_cord(end, self.board)
                 hmsc = self.half_moves_since_capture + 1 if piece_at_end == PieceBoardRepr.e else 0
-                return True, ResponseGameState(new_board, lwsc, lwlc, lbsc, lblc, ILLEGAL_EN_PASSANT, hmsc)
+                return True, ResponseGameState(changes, lwsc, lwlc, lbsc, lblc, ILLEGAL_EN_PASSANT, hmsc)
             return False, None
 
         elif is_knight(piece):
@@ -741,10 +1101,10 @@ class GameState:
                     break
 
             if is_move_on_list:
-                new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
+                changes = get_move_changes(start, end, self.board)
                 piece_at_end = get_piece_repr_from_board_cord(end, self.board)
                 hmsc = self.half_moves_since_capture + 1 if piece_at_end == PieceBoardRepr.e else 0
-                return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                self.legal_white_long_castle, self.legal_black_short_castle,
                                                self.legal_black_long_castle, ILLEGAL_EN_PASSANT, hmsc)
 
@@ -762,10 +1122,10 @@ class GameState:
                     break
 
             if is_move_on_list:
-                new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
+                changes = get_move_changes(start, end, self.board)
                 piece_at_end = get_piece_repr_from_board_cord(end, self.board)
                 hmsc = self.half_moves_since_capture + 1 if piece_at_end == PieceBoardRepr.e else 0
-                return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                self.legal_white_long_castle, self.legal_black_short_castle,
                                                self.legal_black_long_castle, ILLEGAL_EN_PASSANT, hmsc)
 
@@ -790,10 +1150,10 @@ class GameState:
                         break
 
             if is_move_on_list:
-                new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
+                changes = get_move_changes(start, end, self.board)
                 piece_at_end = get_piece_repr_from_board_cord(end, self.board)
                 hmsc = self.half_moves_since_capture + 1 if piece_at_end == PieceBoardRepr.e else 0
-                return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                self.legal_white_long_castle, self.legal_black_short_castle,
                                                self.legal_black_long_castle, ILLEGAL_EN_PASSANT, hmsc)
 
@@ -812,27 +1172,26 @@ class GameState:
                     break
 
             if is_move_on_list:
-                new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
+                changes = get_move_changes(start, end, self.board)
                 piece_at_end = get_piece_repr_from_board_cord(end, self.board)
                 hmsc = self.half_moves_since_capture + 1 if piece_at_end == PieceBoardRepr.e else 0
                 if get_color_of_piece(piece) == Colors.white:
-                    return True, ResponseGameState(new_board, False, False, self.legal_black_short_castle,
+                    return True, ResponseGameState(changes, False, False, self.legal_black_short_castle,
                                                self.legal_black_long_castle, ILLEGAL_EN_PASSANT, hmsc)
-                return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                self.legal_white_long_castle, False, False, ILLEGAL_EN_PASSANT, hmsc)
             else:
                 if self.is_castle(start, end, piece_color):
                     rook_end_cords = (start[0] + end[0]) // 2, (start[1] + end[1]) // 2
                     rook_col = 0 if rook_end_cords[0] == 3 else 7
                     rook_start_cords = rook_col, rook_end_cords[1]
-                    tmp_new_board = get_copy_of_modified_board_after_move_cords(start, end, self.board)
-                    new_board = get_copy_of_modified_board_after_move_cords(rook_start_cords, rook_end_cords,
-                                                                            tmp_new_board)
+                    changes = get_move_changes(start, end, self.board)
+                    changes.extend(get_move_changes(rook_start_cords, rook_end_cords, self.board))
                     if get_color_of_piece(piece) == Colors.white:
-                        return True, ResponseGameState(new_board, False, False, self.legal_black_short_castle,
+                        return True, ResponseGameState(changes, False, False, self.legal_black_short_castle,
                                                        self.legal_black_long_castle, ILLEGAL_EN_PASSANT,
                                                        self.half_moves_since_capture + 1)
-                    return True, ResponseGameState(new_board, self.legal_white_short_castle,
+                    return True, ResponseGameState(changes, self.legal_white_short_castle,
                                                    self.legal_white_long_castle, False, False, ILLEGAL_EN_PASSANT,
                                                    self.half_moves_since_capture + 1)
             return False, None
@@ -841,21 +1200,129 @@ class GameState:
     def move(self, start: (int, int), end: (int, int)):
         is_legal, response_game_state = self.is_move_legal(start, end)
         if is_legal is True:
-            self.board = response_game_state.board
-            self.color_to_move = Colors.black if self.color_to_move == Colors.white else Colors.white
-            self.en_passant = response_game_state.en_passant
-            self.legal_white_short_castle = response_game_state.legal_white_short_castle
-            self.legal_white_long_castle = response_game_state.legal_white_long_castle
-            self.legal_black_short_castle = response_game_state.legal_black_short_castle
-            self.legal_black_long_castle = response_game_state.legal_black_long_castle
-            self.half_moves_since_capture = response_game_state.half_moves_since_capture
-            if self.color_to_move == Colors.white:
-                self.full_moves += 1
+            self.make_move(response_game_state)
+            # Positions before capture or pawn move can't repeat anymore
+            if self.half_moves_since_capture == 0:
+                self.position_hashes = [self.position_hash]
+            else:
+                self.position_hashes.append(self.position_hash)
             return True
         return False
 
-    # Checks whether black or white is mated / stale mated.
+    # Applies already validated move on board in place
+    def make_move(self, response_game_state: ResponseGameState) -> UndoRecord:
+        previous = self.change_board(response_game_state.changes)
+        undo_record = UndoRecord(previous, self.color_to_move,
+                                 self.legal_white_short_castle, self.legal_white_long_castle,
+                                 self.legal_black_short_castle, self.legal_black_long_castle, self.en_passant,
+                                 self.half_moves_since_capture, self.full_moves, self.position_hash)
+
+        position_hash = self.position_hash ^ ZOBRIST_BLACK_TO_MOVE
+        position_hash ^= get_castles_hash(self.legal_white_short_castle, self.legal_white_long_castle,
+                                          self.legal_black_short_castle, self.legal_black_long_castle)
+        position_hash ^= get_en_passant_hash(self.en_passant)
+        piece_counts = self.piece_counts
+        for square, previous_piece in previous:
+            piece = self.board[square]
+            position_hash ^= ZOBRIST_PIECES[previous_piece * 64 + square] ^ ZOBRIST_PIECES[piece * 64 + square]
+            piece_counts[previous_piece] -= 1
+            piece_counts[piece] += 1
+
+        self.color_to_move = Colors.black if self.color_to_move == Colors.white else Colors.white
+        self.en_passant = response_game_state.en_passant
+        self.legal_white_short_castle = response_game_state.legal_white_short_castle
+        self.legal_white_long_castle = response_game_state.legal_white_long_castle
+        self.legal_black_short_castle = response_game_state.legal_black_short_castle
+        self.legal_black_long_castle = response_game_state.legal_black_long_castle
+        self.half_moves_since_capture = response_game_state.half_moves_since_capture
+        if self.color_to_move == Colors.white:
+            self.full_moves += 1
+
+        position_hash ^= get_castles_hash(self.legal_white_short_castle, self.legal_white_long_castle,
+                                          self.legal_black_short_castle, self.legal_black_long_castle)
+        position_hash ^= get_en_passant_hash(self.en_passant)
+        self.position_hash = position_hash
+        return undo_record
+
+    # Applies changes on board and recounts only attacks they touch: of pieces on changed squares and along
+    # lines of other sliders crossing them. Line which reaches a changed square afterwards reached one before
+    # too, so lines are found once. Returns changes that revert it.
+    def change_board(self, changes: List[Tuple[int, PieceBoardRepr]]) -> List[Tuple[int, PieceBoardRepr]]:
+        changed_squares = {square for square, _ in changes}
+        lines = get_lines_through_squares(self.board, changed_squares)
+        self.count_attacks(changed_squares, -1)
+        self.count_line_attacks(lines, -1)
+        previous = apply_changes(changes, self.board)
+        self.count_attacks(changed_squares, 1)
+        self.count_line_attacks(lines, 1)
+        self.king_safety = None
+        return previous
+
+    def count_attacks(self, squares, delta: int):
+        board = self.board
+        attack_maps = self.attack_maps
+        for square in squares:
+            piece = board[square]
+            if piece != PieceBoardRepr.e:
+                offset = PIECE_COLORS[piece].value * 64
+                for target in get_piece_attacks(board, square, piece):
+                    attack_maps[offset + target] += delta
+
+    def count_line_attacks(self, lines, delta: int):
+        board = self.board
+        attack_maps = self.attack_maps
+        for square, direction in lines:
+            offset = PIECE_COLORS[board[square]].value * 64
+            for target in LINE_RAYS[square][direction]:
+                attack_maps[offset + target] += delta
+                if board[target] != PieceBoardRepr.e:
+                    break
+
+    def unmake_move(self, undo_record: UndoRecord):
+        piece_counts = self.piece_counts
+        for square, previous_piece in undo_record.changes:
+            piece_counts[self.board[square]] -= 1
+            piece_counts[previous_piece] += 1
+        self.change_board(list(reversed(undo_record.changes)))
+        self.color_to_move = undo_record.color_to_move
+        self.en_passant = undo_record.en_passant
+        self.legal_white_short_castle = undo_record.legal_white_short_castle
+        self.legal_white_long_castle = undo_record.legal_white_long_castle
+        self.legal_black_short_castle = undo_record.legal_black_short_castle
+        self.legal_black_long_castle = undo_record.legal_black_long_castle
+        self.half_moves_since_capture = undo_record.half_moves_since_capture
+        self.full_moves = undo_record.full_moves
+        self.position_hash = undo_record.position_hash
+
+    def is_fifty_moves_rule_draw(self) -> bool:
+        return self.half_moves_since_capture >= FIFTY_MOVES_RULE_HALF_MOVES
+
+    def is_threefold_repetition(self) -> bool:
+        return self.position_hashes.count(self.position_hash) >= REPETITIONS_TO_DRAW
+
+    # Neither side can mate: kings alone, with one minor piece, or with bishops all on squares of one color
+    def is_insufficient_material(self) -> bool:
+        piece_counts = self.piece_counts
+        for piece in MATING_PIECES:
+            if piece_counts[piece]:
+                return False
+        if piece_counts[PieceBoardRepr.n] + piece_counts[PieceBoardRepr.N] + piece_counts[PieceBoardRepr.b] \
+                + piece_counts[PieceBoardRepr.B] <= 1:
+            return True
+        if piece_counts[PieceBoardRepr.n] or piece_counts[PieceBoardRepr.N]:
+            return False
+        bishops_squares_colors = {(square // 8 + square % 8) % 2 for square, piece in enumerate(self.board)
+                                  if piece == PieceBoardRepr.b or piece == PieceBoardRepr.B}
+        return len(bishops_squares_colors) == 1
+
+    # Cheap counters are checked before looking for mate and stalemate
+    def is_draw(self) -> bool:
+        return self.is_fifty_moves_rule_draw() or self.is_insufficient_material() or self.is_threefold_repetition()
+
+    # Checks whether black or white is mated / stale mated or game is drawn by rules.
     def is_game_over(self):
+        if self.is_draw():
+            return True
         if self.is_stale_mated(Colors.white) or self.is_stale_mated(Colors.black):
             return True
         if self.is_mated(Colors.white) or self.is_mated(Colors.black):
@@ -863,6 +1330,8 @@ class GameState:
         return False
 
     def get_result(self) -> int:
+        if self.is_draw():
+            return 2
         if self.is_mated(Colors.white):
             return 1
         elif self.is_mated(Colors.black):
@@ -874,10 +1343,7 @@ class GameState:
 
     @classmethod
     def get_empty_board(cls):
-        board = []
-        for i in range(8):
-            board.append(8 * [PieceBoardRepr.e])
-        return board
+        return bytearray(64)
 
     @classmethod
     def get_starting_position(cls):
@@ -891,7 +1357,7 @@ class GameState:
         for i in range(8):
             board_as_string += '| '
             for j in range(8):
-                board_as_string += ' ' + board[j][8 - i - 1].value + ' '
+                board_as_string += ' ' + PIECE_SYMBOLS[board[j * 8 + 8 - i - 1]] + ' '
             board_as_string += ' |\n'
         board_as_string += 28 * '-' + '\n'
         return board_as_string
@@ -915,8 +1381,8 @@ class GameState:
             elif x == '/' and column == 8:
                 row -= 1
                 column = 0
-            elif x in PIECES:
-                board[column][row] = PieceBoardRepr(x)
+            elif x in PIECES and x != 'e' and column < 8:
+                board[column * 8 + row] = PieceBoardRepr[x]
                 column += 1
             else:
                 raise Exception("Incorrect Fen")
@@ -0,0 +1,158 @@
+# Bus of game events shared by all workers. Worker which applied a change publishes it to a topic exchange
+# with routing key table.<table_id>.<event>; every worker consumes them over one channel and refreshes
+# its long-poll waiters, spectators and version map. Without the bus other workers would notice the
+# change only at their next periodic check.
+# GAME_EVENT_BUS selects the bus: "rabbitmq", "memory" for in-process fake used offline, empty turns it off.
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from starlette.concurrency import run_in_threadpool
+
+import app.spectators as spectators
+import app.waiters as waiters
+from app.cache import forget_version
+from app.outbox import get_broker_parameters
+
+GAME_EVENT_BUS = os.getenv("GAME_EVENT_BUS", "")
+GAME_EVENTS_EXCHANGE = os.getenv("GAME_EVENTS_EXCHANGE", "game-events")
+# Events waiting for publisher thread, newer ones are dropped when broker can't keep up
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "10000"))
+# Seconds before consumer reconnects to broker
+EVENT_RECONNECT_DELAY = float(os.getenv("EVENT_RECONNECT_DELAY", "5"))
+
+WORKER_ID = uuid.uuid4().hex
+
+EVENT_JOIN = 'join'
+EVENT_START = 'start'
+EVENT_MOVE = 'move'
+EVENT_RESULT = 'result'
+
+bus = None
+
+
+def get_routing_key(table_id: int, event: str) -> str:
+    return 'table.%d.%s' % (table_id, event)
+
+
+def encode_event(table_id: int, event: str) -> bytes:
+    return json.dumps({'table_id': table_id, 'event': event, 'worker': WORKER_ID}).encode()
+
+
+# Refreshes everything which waits for the table, runs on event loop
+async def refresh_table(table_id: int):
+    table = await run_in_threadpool(waiters.load_table, table_id)
+    if table is None:
+        return
+    waiters.wake_waiters(table)
+    if table_id in spectators.SUBSCRIBERS:
+        spectators.broadcast(table_id, *await run_in_threadpool(spectators.get_frame, table))
+
+
+def handle_event(body: bytes):
+    message = json.loads(body)
+    if message['worker'] == WORKER_ID:
+        return
+    table_id = message['table_id']
+    # Version remembered by this worker is stale now
+    forget_version(table_id)
+
+    loop = waiters.loop or spectators.loop
+    if loop is not None and (table_id in waiters.WAITERS or table_id in spectators.SUBSCRIBERS):
+        loop.call_soon_threadsafe(asyncio.ensure_future, refresh_table(table_id))
+
+
+# Fake delivering events to handlers of this process, for running without broker
+class InMemoryBus:
+    def __init__(self):
+        self.handlers = []
+        self.published = []
+
+    def start(self, handler):
+        self.handlers.append(handler)
+
+    def publish(self, table_id: int, event: str):
+        body = encode_event(table_id, event)
+        self.published.append((get_routing_key(table_id, event), body))
+        self.deliver(body)
+
+    def deliver(self, body: bytes):
+        for handler in self.handlers:
+            handler(body)
+
+
+class RabbitMQBus:
+    def __init__(self):
+        self.events = queue.Queue(EVENT_QUEUE_SIZE)
+        self.handler = None
+
+    def start(self, handler):
+        self.handler = handler
+        threading.Thread(target=self.run_publisher, daemon=True).start()
+        threading.Thread(target=self.run_consumer, daemon=True).start()
+
+    # Never blocks request, event is dropped when queue is full
+    def publish(self, table_id: int, event: str):
+        try:
+            self.events.put_nowait((get_routing_key(table_id, event), encode_event(table_id, event)))
+        except queue.Full:
+            print("GAME EVENT DROPPED", table_id, event)
+
+    def connect(self):
+        import pika
+
+        connection = pika.BlockingConnection(get_broker_parameters())
+        channel = connection.channel()
+        channel.exchange_declare(exchange=GAME_EVENTS_EXCHANGE, exchange_type='topic')
+        return connection, channel
+
+    # Blocking connection is not thread-safe, so one thread owns publishing
+    def run_publisher(self):
+        connection = None
+        while True:
+            routing_key, body = self.events.get()
+            try:
+                if connection is None or connection.is_closed:
+                    connection, channel = self.connect()
+                channel.basic_publish(exchange=GAME_EVENTS_EXCHANGE, routing_key=routing_key, body=body)
+            except Exception as e:
+                print("GAME EVENT PUBLISH FAILED", e)
+                connection = None
+
+    # All tables of the worker are multiplexed over one exclusive queue
+    def run_consumer(self):
+        while True:
+            try:
+                connection, channel = self.connect()
+                declared = channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+                queue_name = declared.method.queue
+                channel.queue_bind(exchange=GAME_EVENTS_EXCHANGE, queue=queue_name, routing_key='table.#')
+                channel.basic_consume(queue=queue_name, auto_ack=True,
+                                      on_message_callback=lambda ch, method, properties, body: self.handler(body))
+                channel.start_consuming()
+            except Exception as e:
+                print("GAME EVENT CONSUMER FAILED", e)
+            time.sleep(EVENT_RECONNECT_DELAY)
+
+
+def start_bus():
+    global bus
+    if bus is not None or not GAME_EVENT_BUS:
+        return
+    if GAME_EVENT_BUS == 'memory':
+        bus = InMemoryBus()
+    elif GAME_EVENT_BUS == 'rabbitmq':
+        bus = RabbitMQBus()
+    else:
+        print("UNKNOWN GAME EVENT BUS", GAME_EVENT_BUS)
+        return
+    bus.start(handle_event)
+
+
+def publish_event(table_id: int, event: str):
+    if bus is not None:
+        bus.publish(table_id, event)
@@ -1,116 +1,145 @@
-from datetime import datetime
+from contextlib import nullcontext
 from enum import Enum
-from typing import Optional
+from typing import List, Optional, Tuple
+from app.clock import DEFAULT_TIME_CONTROL, TimeControl, ms_to_iso, now_ms
 from app.engine.chessEngine import GameState
 from sqlalchemy.orm import Session
-import re
 import app.engine.chessEngine as engine
-import pika
-import json
+import app.queries as queries
 
-DEFAULT_PACE = 180
+SEAT_NAMES = ['white_one', 'white_two', 'black_one', 'black_two']
+# Seats in order of making moves: white one, black one, white two, black two
+MOVE_ORDER = (0, 2, 1, 3)
+
+# Started tables held in memory when moves are journaled, table_id -> Table
+LIVE_TABLES = {}
+# Journal of moves on LIVE_TABLES, set by app.journal when it is enabled
+move_journal = None
 
 
 class Result(Enum):
     white = int(0)
     black = int(1)
     draw = int(2)
+    # Closed by reaper, nobody wins
+    aborted = int(3)
     no_result = int(400)
 
 
+def is_white_seat(seat: int) -> bool:
+    return seat < 2
+
+
 class PlayerByTable:
-    def __init__(self, user_nick: str, token: str, clock_time: int = DEFAULT_PACE, player_id: Optional[int] = -1):
+    __slots__ = ('nickname', 'token', 'time_left', 'player_id', 'premove')
+
+    def __init__(self, user_nick: str, token: str, clock_time: int = DEFAULT_TIME_CONTROL.base_ms,
+                 player_id: Optional[int] = -1, premove: Optional[int] = None):
         self.nickname = user_nick
         self.token = token
+        # Milliseconds
         self.time_left = clock_time
         self.player_id = player_id
+        # Packed move made as soon as it is player's turn
+        self.premove = premove
 
 
 class Table:
-    def __init__(self, game_state: engine.GameState,
+    __slots__ = ('table_id', '_game_state', 'fen', 'position_hashes', 'half_moves', 'result', 'seats',
+                 'seat_by_nickname', 'game_start_ms', 'last_move_ms', 'time_control')
+
+    def __init__(self, game_state: Optional[engine.GameState],
                  table_id: Optional[int] = -1, half_moves: Optional[int] = 0,
                  pbt1: Optional[PlayerByTable] = None,
                  pbt2: Optional[PlayerByTable] = None,
                  pbt3: Optional[PlayerByTable] = None,
                  pbt4: Optional[PlayerByTable] = None,
-                 game_start_time: Optional[str] = None,
-                 last_move_time: Optional[str] = None,
-                 result: Optional[Result] = Result.no_result):
+                 game_start_ms: Optional[int] = None,
+                 last_move_ms: Optional[int] = None,
+                 result: Optional[Result] = Result.no_result,
+                 time_control: TimeControl = DEFAULT_TIME_CONTROL,
+                 fen: Optional[str] = None,
+                 position_hashes: Optional[List[int]] = None):
         self.table_id = table_id
-        self.game_state = game_state
+        # Tables loaded from database keep stored position and parse it only when board is needed
+        self._game_state = game_state
+        self.fen = fen
+        self.position_hashes = position_hashes
         self.half_moves = half_moves
         self.result = result
-        self.white_one_PBT: PlayerByTable = pbt1
-        self.white_two_PBT: PlayerByTable = pbt2
-        self.black_one_PBT: PlayerByTable = pbt3
-        self.black_two_PBT: PlayerByTable = pbt4
-        self.game_start_time = datetime.fromisoformat(game_start_time)
-        self.last_move_time = datetime.fromisoformat(last_move_time)
+        # Indexed by seat number: white one, white two, black one, black two
+        self.seats: List[Optional[PlayerByTable]] = [pbt1, pbt2, pbt3, pbt4]
+        self.seat_by_nickname = {pbt.nickname: seat for seat, pbt in enumerate(self.seats) if pbt is not None}
+        # Milliseconds since epoch
+        self.game_start_ms = game_start_ms
+        self.last_move_ms = last_move_ms
+        self.time_control = time_control
+
+    @property
+    def game_state(self) -> engine.GameState:
+        if self._game_state is None:
+            if self.fen is None:
+                raise ValueError("Table %d was loaded without position" % self.table_id)
+            game_state = GameState()
+            game_state.load_game_state_from_fen(self.fen)
+            game_state.load_position_hashes(self.position_hashes)
+            self._game_state = game_state
+            self.fen = None
+            self.position_hashes = None
+        return self._game_state
+
+    # Stored fen is returned as it is while board hasn't been built
+    def get_fen(self) -> str:
+        with self.lock():
+            if self._game_state is None and self.fen is not None:
+                return self.fen
+            return self.game_state.game_state_to_fen()
 
     def get_param_list(self):
         params_list = [self.table_id, self.game_state.game_state_to_fen(), self.half_moves,
-                       self.result, self.game_start_time.isoformat(),
-                       self.last_move_time.isoformat()]
-        wtm_nickname = self.who_to_move()
-        pbt_list = [self.white_one_PBT, self.white_two_PBT, self.black_one_PBT,
-                    self.black_two_PBT]
-
-        for pbt in pbt_list:
-            if pbt is not None:
-                if pbt.nickname == wtm_nickname:
-                    params_list.append(pbt)
+                       self.result, self.game_start_ms, self.last_move_ms, self.game_state.position_hashes]
+        pbt = self.seats[self.seat_to_move()]
+        if pbt is not None:
+            params_list.append(pbt)
         return params_list
 
-    def who_to_move(self) -> str:
-        players_list_order = [self.white_one_PBT, self.black_one_PBT,
-                              self.white_two_PBT, self.black_two_PBT]
-        return players_list_order[self.half_moves % 4].nickname
+    def seat_to_move(self) -> int:
+        return MOVE_ORDER[self.half_moves % 4]
+
+    # None when seat of player to move is empty
+    def who_to_move(self) -> Optional[str]:
+        pbt = self.seats[self.seat_to_move()]
+        return pbt.nickname if pbt is not None else None
 
     def get_number_of_players(self):
-        num = 0
-        num += self.white_one_PBT is not None
-        num += self.white_two_PBT is not None
-        num += self.black_one_PBT is not None
-        num += self.black_two_PBT is not None
-        return num
+        return len(self.seat_by_nickname)
 
     def add_player(self, nickname: str, token: str, db: Session):
-        pbt_list = [self.white_one_PBT, self.white_two_PBT,
-                    self.black_one_PBT, self.black_two_PBT]
-
         # check for unique nickname
-        for pbt in pbt_list:
-            if pbt is not None:
-                if pbt.nickname == nickname:
-                    return False
-
-        if self.white_one_PBT is None:
-            self.white_one_PBT = PlayerByTable(nickname, token, DEFAULT_PACE)
-            return add_player_to_table_db(self.table_id, nickname, token, 0, db)
-
-        if self.white_two_PBT is None:
-            self.white_two_PBT = PlayerByTable(nickname, token, DEFAULT_PACE)
-            return add_player_to_table_db(self.table_id, nickname, token, 1, db)
-
-        if self.black_one_PBT is None:
-            self.black_one_PBT = PlayerByTable(nickname, token, DEFAULT_PACE)
-            return add_player_to_table_db(self.table_id, nickname, token, 2, db)
+        if nickname in self.seat_by_nickname:
+            return False
 
-        if self.black_two_PBT is None:
-            self.black_two_PBT = PlayerByTable(nickname, token, DEFAULT_PACE)
-            return add_player_to_table_db(self.table_id, nickname, token, 3, db)
+        for seat in range(len(self.seats)):
+            if self.seats[seat] is None:
+                self.seats[seat] = PlayerByTable(nickname, token, self.time_control.base_ms)
+                self.seat_by_nickname[nickname] = seat
+                return add_player_to_table_db(self.table_id, nickname, token, seat, self.time_control.base_ms, db)
 
         return False
 
     def is_this_player_by_table(self, nickname: str, token: str):
-        player_list = [self.white_one_PBT, self.white_two_PBT, self.black_one_PBT, self.black_two_PBT]
-
-        for player in player_list:
-            if player.nickname == nickname and player.token == token:
-                return True
+        seat = self.seat_by_nickname.get(nickname)
+        if seat is not None and self.seats[seat].token == token:
+            return True
         print("Player is not by the table")
         return False
 
+    # Seat of player by the table, None when nickname and token don't match
+    def get_seat_of_player(self, nickname: str, token: str) -> Optional[int]:
+        if not self.is_this_player_by_table(nickname, token):
+            return None
+        return self.seat_by_nickname[nickname]
+
     def validate_whether_player_can_move(self, nickname: str, token: str) -> bool:
         if self.is_this_player_by_table(nickname, token):
             if self.who_to_move() == nickname:
@@ -123,310 +152,468 @@ class Table:
         if self.get_number_of_players() < 4:
             return False
 
-        self.game_start_time = datetime.now()
-        self.last_move_time = datetime.now()
-        print("GAME NUMBER " + str(self.table_id) + " STARTED", self.last_move_time.__repr__())
-        start_game_in_db(self.table_id, db)
+        self.game_start_ms = now_ms()
+        self.last_move_ms = self.game_start_ms
+        print("GAME NUMBER " + str(self.table_id) + " STARTED", ms_to_iso(self.last_move_ms))
+        start_game_in_db(self.table_id, self.game_start_ms, db)
         return True
 
     def get_pbt_by_nickname(self, nickname: str):
-        pbts_list = [self.white_one_PBT, self.white_two_PBT,
-                     self.black_one_PBT, self.black_two_PBT]
-
-        for x in pbts_list:
-            if x.nickname == nickname:
-                return x
+        seat = self.seat_by_nickname.get(nickname)
+        if seat is not None:
+            return self.seats[seat]
 
     def get_result_color_by_nickname_of_player_flagged(self, nickname: str):
-        if nickname == self.white_one_PBT.nickname or nickname == self.white_two_PBT.nickname:
-            return Result.black
-        if nickname == self.black_one_PBT.nickname or nickname == self.black_two_PBT.nickname:
-            return Result.white
-        return Result.no_result
+        seat = self.seat_by_nickname.get(nickname)
+        if seat is None:
+            return Result.no_result
+        return Result.black if is_white_seat(seat) else Result.white
 
+    # Clock of provisioned table starts with its first move, so white one is not charged for waiting
     def update_players_times(self):
-        pbt_list = [self.white_one_PBT, self.white_two_PBT,
-                    self.black_one_PBT, self.black_two_PBT]
-        wtm_nickname = self.who_to_move()
-
-        for pbt in pbt_list:
-            if pbt is not None:
-                if pbt.nickname == wtm_nickname:
-                    time_now = datetime.now()
-                    time_delta = (time_now - self.last_move_time)
-                    elapsed_seconds = time_delta.total_seconds()
-
-                    pbt.time_left -= int(elapsed_seconds)
-                    self.last_move_time = datetime.now()
-
-    # updates times
+        pbt = self.seats[self.seat_to_move()]
+        if pbt is not None:
+            time_now = now_ms()
+            if self.last_move_ms is None:
+                self.game_start_ms = self.last_move_ms = time_now
+            pbt.time_left = self.time_control.charge(pbt.time_left, time_now - self.last_move_ms)
+            self.last_move_ms = time_now
+
+    def get_journal(self):
+        return move_journal if LIVE_TABLES.get(self.table_id) is self else None
+
+    # Live table is shared by all requests, anything reading its board or more than one field holds
+    # the journal lock, so it never sees half-made move
+    def lock(self):
+        journal = self.get_journal()
+        return journal.lock if journal is not None else nullcontext()
+
+    # updates times. Move and premoves it triggers are committed at once, games row loaded by
+    # get_table_for_move stays locked until then
     def move(self, nickname: str, token: str, move_string: str, db: Session) -> bool:
+        journal = self.get_journal()
+        if journal is None:
+            moved = self.make_move(nickname, token, move_string, db, None)
+            db.commit()
+            return moved
+        with journal.lock:
+            moved = self.make_move(nickname, token, move_string, db, journal)
+            db.commit()
+            return moved
+
+    # Move of player holding verified seat token, credentials are taken from the seat
+    def move_from_seat(self, seat: int, move_string: str, db: Session) -> bool:
+        pbt = self.seats[seat] if 0 <= seat < len(self.seats) else None
+        if pbt is None:
+            return False
+        return self.move(pbt.nickname, pbt.token, move_string, db)
+
+    def make_move(self, nickname: str, token: str, move_string: str, db: Session, journal) -> bool:
         if self.validate_whether_player_can_move(nickname, token):
-            game_state = self.game_state
-            start = (int(move_string[0]), int(move_string[1]))
-            end = (int(move_string[2]), int(move_string[3]))
+            packed_move = engine.move_string_to_move(move_string)
+            if packed_move is None:
+                return False
             pbt = self.get_pbt_by_nickname(nickname)
+            # Premove left from a turn which started before it was saved is dropped by this move
+            pbt.premove = None
+            if self.apply_move(pbt, packed_move, db, journal):
+                self.play_premoves(db, journal)
+                return True
+        return False
 
-            if game_state.move(start, end):
-                self.update_players_times()
-
-                if pbt.time_left < 0:
-                    self.result = self.get_result_color_by_nickname_of_player_flagged(nickname)
+    def apply_move(self, pbt: PlayerByTable, packed_move: int, db: Session, journal) -> bool:
+        if not self.game_state.move(*engine.decode_move(packed_move)):
+            return False
+        self.update_players_times()
+
+        if pbt.time_left < 0:
+            self.result = self.get_result_color_by_nickname_of_player_flagged(pbt.nickname)
+
+        if journal is None or not journal.append(self, packed_move):
+            params_list = self.get_param_list()
+            update_db_after_move(params_list, db)
+            # Flag fall of the mover is saved with its leaderboard events
+            events_params = get_result_events_params(self)
+            if events_params is not None:
+                db.execute(queries.INSERT_RESULT_EVENTS, events_params)
+        self.half_moves += 1
+        return True
 
-                params_list = self.get_param_list()
-                update_db_after_move(params_list, db)
-                return True
+    # Makes premoves of the next players right after the move which gave them the turn, so their clocks
+    # run only for the time of making them. Premove which is illegal in the new position is cancelled.
+    def play_premoves(self, db: Session, journal):
+        for _ in range(len(MOVE_ORDER)):
+            pbt = self.seats[self.seat_to_move()]
+            if pbt is None or pbt.premove is None or self.get_result_value() != Result.no_result.value:
+                return
+            packed_move = pbt.premove
+            pbt.premove = None
+            if not self.apply_move(pbt, packed_move, db, journal):
+                print("PREMOVE CANCELLED", self.table_id, pbt.nickname)
+                if journal is None:
+                    update_premove_db(pbt, db)
+                return
+
+    # Queues move for the next turn of the player, or makes it at once when it is their turn already.
+    # Returns True when move was made, False when it was queued and None when it was refused.
+    def premove(self, nickname: str, token: str, move_string: str, db: Session) -> Optional[bool]:
+        journal = self.get_journal()
+        if journal is None:
+            moved = self.set_premove(nickname, token, move_string, db, None)
+            db.commit()
+            return moved
+        with journal.lock:
+            moved = self.set_premove(nickname, token, move_string, db, journal)
+            db.commit()
+            return moved
+
+    def premove_from_seat(self, seat: int, move_string: str, db: Session) -> Optional[bool]:
+        pbt = self.seats[seat] if 0 <= seat < len(self.seats) else None
+        if pbt is None:
+            return None
+        return self.premove(pbt.nickname, pbt.token, move_string, db)
+
+    # Move_string None cancels queued premove
+    def set_premove(self, nickname: str, token: str, move_string: Optional[str], db: Session,
+                    journal) -> Optional[bool]:
+        if not self.is_this_player_by_table(nickname, token) or self.get_result_value() != Result.no_result.value:
+            return None
+        packed_move = None
+        if move_string is not None:
+            packed_move = engine.move_string_to_move(move_string)
+            if packed_move is None:
+                return None
+            if self.who_to_move() == nickname:
+                # Nothing would make premove of the first player once the game starts
+                if self.get_number_of_players() < 4:
+                    return None
+                return True if self.make_move(nickname, token, move_string, db, journal) else None
+
+        pbt = self.get_pbt_by_nickname(nickname)
+        pbt.premove = packed_move
+        # Premoves of journaled tables are saved by the next checkpoint
+        if journal is None:
+            update_premove_db(pbt, db)
+        else:
+            journal.mark_dirty(self.table_id)
         return False
 
-    def update_leaderboard(self):
-        credentials = pika.PlainCredentials('rabbit', 'HyLU1eKw42oI')
-        parameters = pika.ConnectionParameters('34.118.13.126', 5672, '/', credentials, heartbeat=0)
-        rabbit_connection = pika.BlockingConnection(parameters)
-        channel = rabbit_connection.channel()
-        channel.exchange_declare(exchange='message-exchange', exchange_type='fanout')
-        channel.queue_declare(queue='update-leaderboard', durable=True)
-        channel.queue_bind(exchange='message-exchange', queue='update-leaderboard')
-
-        print("UPDATING LEADERBOARD")
-        pbts = [self.white_one_PBT, self.white_two_PBT,
-                self.black_one_PBT, self.black_two_PBT]
-        for pbt in pbts:
-            if self.did_nickname_won(pbt.nickname):
-                data = {'nickname': pbt.nickname, 'result': 'won'}
-                channel.basic_publish(exchange='message-exchange',
-                                      routing_key='update-leaderboard',
-                                      body=json.dumps(data))
-                print(" [x] Sent %r'", json.dumps(data))
-            elif self.did_nickname_drawn(pbt.nickname):
-                data = {'nickname': pbt.nickname, 'result': 'draw'}
-                channel.basic_publish(exchange='message-exchange',
-                                      routing_key='update-leaderboard',
-                                      body=json.dumps(data))
-                print(" [x] Sent %r'", json.dumps(data))
-            elif self.did_nickname_lost(pbt.nickname):
-                data = {'nickname': pbt.nickname, 'result': 'lost'}
-                channel.basic_publish(exchange='message-exchange',
-                                      routing_key='update-leaderboard',
-                                      body=json.dumps(data))
-                print(" [x] Sent %r'", json.dumps(data))
-            else:
-                print(pbt.nickname, "dont have result")
+    # Repeats move read from journal, it was validated when it was made
+    def replay_move(self, packed_move: int, time_left: int, move_ms: int):
+        pbt = self.seats[self.seat_to_move()]
+        self.game_state.move(*engine.decode_move(packed_move))
+        pbt.time_left = time_left
+        pbt.premove = None
+        if self.last_move_ms is None:
+            self.game_start_ms = move_ms
+        self.last_move_ms = move_ms
+        if pbt.time_left < 0:
+            self.result = self.get_result_color_by_nickname_of_player_flagged(pbt.nickname)
+        self.half_moves += 1
 
     def is_game_over(self) -> bool:
-        if self.last_move_time is not None:
-            time_elapsed = (datetime.now() - self.last_move_time).total_seconds()
-            if time_elapsed >= 5:
-                self.update_players_times()
+        with self.lock():
+            if self.result != Result.no_result and self.result != 400:
+                return True
 
-        if self.result != Result.no_result and self.result != 400:
-            return True
+            # Stored clocks are not touched, they change only with moves
+            seconds_to_flag = self.get_seconds_to_flag()
+            if seconds_to_flag is not None and seconds_to_flag < 0:
+                self.result = self.get_result_color_by_nickname_of_player_flagged(self.who_to_move())
+                return True
 
-        pbt_list = [self.white_one_PBT, self.white_two_PBT, self.black_two_PBT, self.black_one_PBT]
-        for pbt in pbt_list:
-            if pbt is not None:
-                if pbt.time_left < 0:
-                    self.result = self.get_result_color_by_nickname_of_player_flagged(pbt.nickname)
-                    self.update_leaderboard()
-                    return True
+            for pbt in self.seats:
+                if pbt is not None:
+                    if pbt.time_left < 0:
+                        self.result = self.get_result_color_by_nickname_of_player_flagged(pbt.nickname)
+                        return True
 
-        if self.game_state.is_game_over():
-            score = self.game_state.get_result()
-            self.result = Result(score)
-            self.update_leaderboard()
-            self.result = score
-            return True
-        return False
+            if self.game_state.is_game_over():
+                self.result = Result(self.game_state.get_result())
+                return True
+            return False
 
     def get_result_of_game(self) -> int:
         self.is_game_over()
-        result = self.result
-        if type(result) == Result:
-            return result.value
-        return result
+        return self.get_result_value()
 
     # Following methods assume nickname exists in game
     def did_nickname_won(self, nickname: str) -> bool:
-        if self.result == Result.no_result or self.result == Result.draw:
-            return False
-
-        if self.result == Result.white:
-            if nickname == self.white_one_PBT.nickname or \
-                    nickname == self.white_two_PBT.nickname:
-                return True
-
-        if self.result == Result.black:
-            if nickname == self.black_one_PBT.nickname or \
-                    nickname == self.black_two_PBT.nickname:
-                return True
+        result = self.get_result_value()
+        if result == Result.white.value:
+            return is_white_seat(self.seat_by_nickname[nickname])
+        if result == Result.black.value:
+            return not is_white_seat(self.seat_by_nickname[nickname])
         return False
 
     def did_nickname_drawn(self, nickname: str) -> bool:
-        if self.result == Result.draw:
-            players_list = [self.white_one_PBT, self.white_two_PBT,
-                            self.black_one_PBT, self.black_two_PBT]
-            if nickname in players_list:
-                return True
-        return False
+        return self.get_result_value() == Result.draw.value and nickname in self.seat_by_nickname
 
     def did_nickname_lost(self, nickname: str) -> bool:
-        if self.result == Result.no_result or self.result == Result.draw:
-            return False
-
-        if self.result == Result.black:
-            if nickname == self.white_one_PBT.nickname or \
-                    nickname == self.white_two_PBT.nickname:
-                return True
-
-        if self.result == Result.white:
-            if nickname == self.black_one_PBT.nickname or \
-                    nickname == self.black_two_PBT.nickname:
-                return True
+        result = self.get_result_value()
+        if result == Result.black.value:
+            return is_white_seat(self.seat_by_nickname[nickname])
+        if result == Result.white.value:
+            return not is_white_seat(self.seat_by_nickname[nickname])
         return False
 
-    # Returns JSON
+    # Returns (nickname, 'won' / 'draw' / 'lost') for leaderboard, nothing when game is not over or was aborted
+    def get_leaderboard_results(self) -> List[Tuple[str, str]]:
+        results = []
+        for pbt in self.seats:
+            if pbt is None:
+                continue
+            if self.did_nickname_won(pbt.nickname):
+                results.append((pbt.nickname, 'won'))
+            elif self.did_nickname_drawn(pbt.nickname):
+                results.append((pbt.nickname, 'draw'))
+            elif self.did_nickname_lost(pbt.nickname):
+                results.append((pbt.nickname, 'lost'))
+        return results
+
+    def get_result_value(self) -> int:
+        if type(self.result) == Result:
+            return self.result.value
+        return self.result
+
+    # Version changes whenever anything but the running clock changes
+    def get_version(self):
+        return self.half_moves, self.get_result_value(), self.get_number_of_players()
+
+    # Seconds left on the clock of player to move, None when clocks are not running
+    def get_seconds_to_flag(self):
+        if self.get_number_of_players() < 4 or self.get_result_value() != Result.no_result.value or \
+                self.last_move_ms is None:
+            return None
+        pbt = self.seats[self.seat_to_move()]
+        used_ms = self.time_control.get_used_ms(now_ms() - self.last_move_ms)
+        return (pbt.time_left - used_ms) / 1000
+
+    # Returns JSON with everything needed to render one frame; clocks are stored values in seconds,
+    # the player to move has been thinking since last_move_time
+    def get_state(self):
+        with self.lock():
+            seats = {}
+            times = {}
+            for seat_name, pbt in zip(SEAT_NAMES, self.seats):
+                seats[seat_name] = pbt.nickname if pbt is not None else None
+                if pbt is not None:
+                    times[pbt.nickname] = pbt.time_left / 1000
+
+            to_move = self.who_to_move() if self.get_number_of_players() == 4 else None
+            return {'table_id': self.table_id, 'fen': self.get_fen(),
+                    'halfmoves': self.half_moves, 'result': self.get_result_value(), 'to_move': to_move,
+                    'seats': seats, 'times': times, 'last_move_time': ms_to_iso(self.last_move_ms)}
+
+    # Returns JSON with stored clocks in seconds, same as in get_state, the player to move has been
+    # thinking since last_move_time
     def get_times(self):
-        nickname_to_move = self.who_to_move()
-
-        pbt_list = [self.white_one_PBT, self.white_two_PBT, self.black_one_PBT, self.black_two_PBT]
         times = {}
-        for pbt in pbt_list:
+        for pbt in self.seats:
             if pbt is not None:
-                if pbt.nickname == nickname_to_move and self.get_number_of_players() == 4:
-                    time_now = datetime.now()
-                    time_delta = (time_now - self.last_move_time)
-                    elapsed_seconds = time_delta.total_seconds()
-                    times[pbt.nickname] = pbt.time_left - elapsed_seconds
-                else:
-                    times[pbt.nickname] = pbt.time_left
+                times[pbt.nickname] = pbt.time_left / 1000
         return times
 
 
 def get_table_by_id(table_id: int, db: Session) -> Table:
+    table = LIVE_TABLES.get(table_id)
+    if table is not None:
+        return table
     return get_table_by_id_db(table_id, db)
 
 
-def create_new_table(nickname: str, token: str, db: Session):
+# Table for endpoints which read only seats and clocks, position is not even fetched
+def get_boardless_table_by_id(table_id: int, db: Session) -> Table:
+    table = LIVE_TABLES.get(table_id)
+    if table is not None:
+        return table
+    data = db.execute(queries.SELECT_BOARDLESS_GAME, {'table_id': table_id}).fetchone()
+    if data is None:
+        return None
+    return get_table_from_data(data)
+
+
+# Same as get_table_by_id, but games row is locked until the move is committed, so concurrent move
+# or premove loads the table only after it. When moves are journaled started table is kept in memory
+# from now on.
+def get_table_for_move(table_id: int, db: Session) -> Table:
+    table = LIVE_TABLES.get(table_id)
+    if table is None:
+        db.execute(queries.LOCK_GAME, {'table_id': table_id})
+        table = get_table_by_id_db(table_id, db)
+    if move_journal is None or table is None or table.table_id in LIVE_TABLES:
+        return table
+    if table.get_number_of_players() == 4 and table.get_result_value() == Result.no_result.value:
+        table = LIVE_TABLES.setdefault(table_id, table)
+    return table
+
+
+def create_new_table(nickname: str, token: str, db: Session, time_control: TimeControl = DEFAULT_TIME_CONTROL):
     new_game_state = engine.GameState()
     new_game_state_fen = new_game_state.game_state_to_fen()
-    game_id = create_game_db(nickname, token, DEFAULT_PACE, new_game_state_fen, db)
+    game_id = create_game_db(nickname, token, time_control, new_game_state_fen, db)
 
     return game_id
 
 
+def create_new_full_tables(seatings: List[List[Tuple[str, str]]], db: Session,
+                           time_control: TimeControl = DEFAULT_TIME_CONTROL):
+    new_game_state_fen = engine.GameState().game_state_to_fen()
+    return create_full_tables_db(seatings, time_control, new_game_state_fen, db)
+
+
+def get_time_control_params(time_control: TimeControl):
+    return {'base_time_ms': time_control.base_ms, 'increment_ms': time_control.increment_ms,
+            'delay_ms': time_control.delay_ms}
+
+
 # Returns player id in db
-def add_player_db(nickname: str, token: str, pace: int, db: Session) -> int:
-    db.execute(
-        f"INSERT INTO players (nickname, token, time_left) VALUES ('{nickname}', '{token}', '{pace}')"
-    )
+def add_player_db(nickname: str, token: str, time_left_ms: int, db: Session) -> int:
+    res = db.execute(queries.INSERT_PLAYER, {'nickname': nickname, 'token': token, 'time_left_ms': time_left_ms})
+    player_id = res.fetchone()[0]
     db.commit()
-    return get_player_id_from_db(nickname, token, db)
+    return player_id
 
 
 def get_player_id_from_db(nickname: str, token: str, db: Session) -> int:
-    is_in_db = db.execute(
-        f"SELECT player_id FROM players WHERE nickname = :nickname AND token = :token",
-        {'nickname': nickname, 'token': token}
-    ).fetchone()
+    is_in_db = db.execute(queries.SELECT_PLAYER_ID, {'nickname': nickname, 'token': token}).fetchone()
 
     if is_in_db is None:
         return -1
 
-    return int(re.sub('[^0-9]', '', str(is_in_db)))
+    return is_in_db[0]
 
 
-def create_game_db(nickname: str, token: str, pace: int, fen: str, db: Session) -> int:
+def create_game_db(nickname: str, token: str, time_control: TimeControl, fen: str, db: Session) -> int:
     # check if player in DB
     player_id = get_player_id_from_db(nickname, token, db)
-    if player_id is not -1:
+    if player_id != -1:
         return -1
-    add_player_db(nickname, token, pace, db)
-
-    time_now = datetime.now()
-    iso_time = time_now.isoformat()
-    data = db.execute(
-        f"SELECT player_id FROM players WHERE nickname = :nickname AND token = :token",
-        {'nickname': nickname, 'token': token}
-    ).fetchone()
+    player_id = add_player_db(nickname, token, time_control.base_ms, db)
 
     res = db.execute(
-        "INSERT INTO games (white_one_id, white_two_id, black_one_id, black_two_id, halfmoves, "
-        "result, game_start_time, last_move_time, fen) VALUES (:woid, :wtid, :boid, :btid, "
-        ":halfmoves, :result, :start_time, :last_move_time, :fen) RETURNING game_id",
-        {'woid': data[0], 'wtid': -1, 'boid': -1, 'btid': -1, 'halfmoves': 0, 'result': 400,
-         'start_time': str(iso_time), 'last_move_time': str(iso_time), 'fen': str(fen)}
+        queries.INSERT_GAME,
+        {'woid': player_id, 'wtid': -1, 'boid': -1, 'btid': -1, 'halfmoves': 0, 'result': 400,
+         'start_ms': now_ms(), 'fen': str(fen), **get_time_control_params(time_control)}
     )
+    game_id = res.fetchone()[0]
     db.commit()
-    game_id_str = res.fetchone()
-    return int(re.sub('[^0-9]', '', str(game_id_str)))
+    return game_id
+
+
+# Creates already started tables with all seats taken, seatings are lists of 4 (nickname, token) pairs
+# in white one, white two, black one, black two order. Returns ids of the tables in the same order
+# or None when some of the players is already in game.
+def create_full_tables_db(seatings: List[List[Tuple[str, str]]], time_control: TimeControl, fen: str, db: Session):
+    nicknames = [nickname for seating in seatings for nickname, _ in seating]
+    tokens = [token for seating in seatings for _, token in seating]
+
+    already_in_game = db.execute(queries.SELECT_ANY_OF_PLAYERS,
+                                 {'nicknames': nicknames, 'tokens': tokens}).fetchone()
+    if already_in_game is not None:
+        return None
+
+    players_data = db.execute(queries.INSERT_PLAYERS,
+                              {'nicknames': nicknames, 'tokens': tokens,
+                               'time_left_ms': time_control.base_ms}).fetchall()
+    player_id_by_credentials = {(row[1], row[2]): row[0] for row in players_data}
+
+    seats_ids = [[player_id_by_credentials[credentials] for credentials in seating] for seating in seatings]
+    games_data = db.execute(
+        queries.INSERT_FULL_GAMES,
+        {'result': Result.no_result.value, 'start_ms': now_ms(), 'fen': fen, **get_time_control_params(time_control),
+         'woids': [ids[0] for ids in seats_ids], 'wtids': [ids[1] for ids in seats_ids],
+         'boids': [ids[2] for ids in seats_ids], 'btids': [ids[3] for ids in seats_ids]}
+    ).fetchall()
+    db.commit()
+
+    table_id_by_white_one_id = {row[1]: row[0] for row in games_data}
+    return [table_id_by_white_one_id[ids[0]] for ids in seats_ids]
 
 
 def get_table_by_id_db(table_id: int, db: Session):
-    data = db.execute(
-        "SELECT game_id, white_one_id, white_two_id, black_one_id, black_two_id, halfmoves, "
-        "result, game_start_time, last_move_time, fen FROM "
-        "games WHERE game_id = :table_id", {'table_id': table_id}).fetchone()
+    data = db.execute(queries.SELECT_GAME, {'table_id': table_id}).fetchone()
     if data is None:
         return None
-    print(data)
-    loaded_game_state = GameState()
-    loaded_game_state.load_game_state_from_fen(data[9])
+    return get_table_from_data(data)
+
 
-    players_ids = [data[1], data[2], data[3], data[4]]
+# Loads many tables with one set-based query
+def get_tables_by_ids_db(table_ids: List[int], db: Session) -> List[Table]:
+    games_data = db.execute(queries.SELECT_GAMES_BY_IDS, {'table_ids': list(table_ids)}).fetchall()
+    return get_tables_from_games_data(games_data)
+
+
+# Returns page of tables which game has not finished yet
+def get_live_tables_db(offset: int, limit: int, db: Session) -> List[Table]:
+    games_data = db.execute(
+        queries.SELECT_LIVE_GAMES,
+        {'no_result': Result.no_result.value, 'limit': limit, 'offset': offset}).fetchall()
+    return get_tables_from_games_data(games_data)
+
+
+def get_tables_from_games_data(games_data) -> List[Table]:
+    # Tables held in memory are newer than their rows
+    return [LIVE_TABLES.get(data[0]) or get_table_from_data(data) for data in games_data]
+
+
+# Builds table from row of SEATED_GAME_COLUMNS, board is built on first use
+def get_table_from_data(data) -> Table:
     pbt_list = []
-    for player_id in players_ids:
-        if player_id != -1:
-            player_from_db = db.execute(
-                "SELECT player_id, nickname, token, time_left FROM players WHERE player_id = :player_id",
-                {'player_id': player_id}
-            ).fetchone()
-            pbt_list.append(PlayerByTable(player_from_db[1], player_from_db[2], player_from_db[3],
-                                          player_from_db[0]))
+    for seat in range(4):
+        player_id = data[1 + seat]
+        nickname, token, time_left, premove = data[14 + 4 * seat:18 + 4 * seat]
+        # Players of aborted tables are deleted, their seats stay taken
+        if player_id != -1 and nickname is not None:
+            pbt_list.append(PlayerByTable(nickname, token, time_left, player_id, premove))
         else:
             pbt_list.append(None)
 
-    my_table = Table(loaded_game_state, data[0], data[5], pbt_list[0], pbt_list[1], pbt_list[2],
-                     pbt_list[3], data[7], data[8], result=data[6])
-    return my_table
+    return Table(None, data[0], data[5], pbt_list[0], pbt_list[1], pbt_list[2], pbt_list[3], data[7], data[8],
+                 result=data[6], time_control=TimeControl(data[11], data[12], data[13]), fen=data[9],
+                 position_hashes=data[10])
 
 
-def add_player_to_table_db(table_id: int, nickname: str, token: str, position: int, db: Session) -> bool:
+def add_player_to_table_db(table_id: int, nickname: str, token: str, position: int, time_left_ms: int,
+                           db: Session) -> bool:
+    if not 0 <= position < len(SEAT_NAMES):
+        return False
     player_id = get_player_id_from_db(nickname, token, db)
-    if player_id is not -1:
+    if player_id != -1:
         return False
-    player_id = add_player_db(nickname, token, DEFAULT_PACE, db)
+    player_id = add_player_db(nickname, token, time_left_ms, db)
     print("join table", player_id, table_id)
-    if position == 0:
-        db.execute("UPDATE games SET white_one_id = :new_value WHERE game_id = :table_id",
-                   {'new_value': player_id, 'table_id': table_id})
-        db.commit()
-        return True
-    elif position == 1:
-        db.execute("UPDATE games SET white_two_id = :new_value WHERE game_id = :table_id",
-                   {'new_value': player_id, 'table_id': table_id})
-        db.commit()
-        return True
-    elif position == 2:
-        db.execute("UPDATE games SET black_one_id = :new_value WHERE game_id = :table_id",
-                   {'new_value': player_id, 'table_id': table_id})
-        db.commit()
-        return True
-    elif position == 3:
-        db.execute("UPDATE games SET black_two_id = :new_value WHERE game_id = :table_id",
-                   {'new_value': player_id, 'table_id': table_id})
+
+    res = db.execute(queries.TAKE_SEAT[position], {'new_value': player_id, 'table_id': table_id})
+    if res.rowcount == 0:
+        db.execute(queries.DELETE_PLAYER, {'player_id': player_id})
         db.commit()
-        return True
-    return False
+        return False
+    db.commit()
+    return True
 
 
-def start_game_in_db(table_id: int, db: Session):
-    time_now = datetime.now()
-    iso_time_now = time_now.isoformat()
-    db.execute(
-        "UPDATE games SET game_start_time = :iso_t WHERE game_id = :table_id",
-        {'iso_t': str(iso_time_now), 'table_id': table_id})
-    db.execute(
-        "UPDATE games SET last_move_time = :iso_t WHERE game_id = :table_id",
-        {'iso_t': str(iso_time_now), 'table_id': table_id})
+# Creates tables without any players, returns their ids
+def create_empty_tables_db(count: int, db: Session, time_control: TimeControl = DEFAULT_TIME_CONTROL) -> List[int]:
+    res = db.execute(
+        queries.INSERT_EMPTY_GAMES,
+        {'result': Result.no_result.value, 'start_ms': now_ms(), 'fen': engine.GameState().game_state_to_fen(),
+         'count': count, **get_time_control_params(time_control)}
+    )
+    tables_ids = [row[0] for row in res.fetchall()]
+    db.commit()
+    return tables_ids
+
+
+# Returns (table id, number of free seats) of tables with given time control waiting for players
+def get_open_tables_db(db: Session, time_control: TimeControl = DEFAULT_TIME_CONTROL):
+    data = db.execute(queries.SELECT_OPEN_GAMES,
+                      {'no_result': Result.no_result.value, **get_time_control_params(time_control)}).fetchall()
+    return [(row[0], row[1]) for row in data]
+
+
+def start_game_in_db(table_id: int, start_ms: int, db: Session):
+    db.execute(queries.START_GAME, {'start_ms': start_ms, 'table_id': table_id})
     db.commit()
 
 
@@ -437,39 +624,106 @@ def update_db_after_move(params_list, db: Session):
     result = params_list[3]
     if type(result) == Result:
         result = result.value
-    game_start_time = params_list[4]
-    last_move_time = params_list[5]
-    pbt_to_move = params_list[6]
-    db.execute(
-        "UPDATE players SET time_left = :time_left WHERE player_id = :player_id",
-        {'time_left': pbt_to_move.time_left, 'player_id': pbt_to_move.player_id}
-    )
-    db.execute(
-        "UPDATE games SET fen = :new_val WHERE game_id = :table_id",
-        {'new_val': fen, 'table_id': table_id}
-    )
-    db.execute(
-        "UPDATE games SET halfmoves = :new_val WHERE game_id = :table_id",
-        {'new_val': half_moves, 'table_id': table_id}
-    )
+    game_start_ms = params_list[4]
+    last_move_ms = params_list[5]
+    position_hashes = params_list[6]
+    pbt_to_move = params_list[7]
+    db.execute(queries.UPDATE_PLAYER_TIME,
+               {'time_left_ms': pbt_to_move.time_left, 'premove': pbt_to_move.premove,
+                'player_id': pbt_to_move.player_id})
     db.execute(
-        "UPDATE games SET result = :new_val WHERE game_id = :table_id",
-        {'new_val': result, 'table_id': table_id}
-    )
-    db.execute(
-        "UPDATE games SET game_start_time = :new_val WHERE game_id = :table_id",
-        {'new_val': game_start_time, 'table_id': table_id}
-    )
-    db.execute(
-        "UPDATE games SET last_move_time = :new_val WHERE game_id = :table_id",
-        {'new_val': last_move_time, 'table_id': table_id}
+        queries.UPDATE_GAME_AFTER_MOVE,
+        {'fen': fen, 'halfmoves': half_moves, 'result': result, 'game_start_ms': game_start_ms,
+         'last_move_ms': last_move_ms, 'position_hashes': position_hashes, 'table_id': table_id}
     )
+
+
+def update_premove_db(pbt: PlayerByTable, db: Session):
+    db.execute(queries.UPDATE_PLAYER_PREMOVE, {'premove': pbt.premove, 'player_id': pbt.player_id})
+
+
+# Returns parameters of statements saving given tables, used by journal checkpoints
+def get_checkpoint_params(tables: List[Table]):
+    games_params = []
+    players_params = []
+    events_params = []
+    for table in tables:
+        games_params.append({'fen': table.game_state.game_state_to_fen(), 'halfmoves': table.half_moves,
+                             'result': table.get_result_value(),
+                             'game_start_ms': table.game_start_ms, 'last_move_ms': table.last_move_ms,
+                             'position_hashes': table.game_state.position_hashes, 'table_id': table.table_id})
+        for pbt in table.seats:
+            players_params.append({'time_left_ms': pbt.time_left, 'premove': pbt.premove,
+                                   'player_id': pbt.player_id})
+        table_events_params = get_result_events_params(table)
+        if table_events_params is not None:
+            events_params.append(table_events_params)
+    return games_params, players_params, events_params
+
+
+def save_checkpoint_db(games_params, players_params, events_params, db: Session):
+    if games_params:
+        db.execute(queries.UPDATE_GAME_AFTER_MOVE, games_params)
+    if players_params:
+        db.execute(queries.UPDATE_PLAYER_TIME, players_params)
+    if events_params:
+        db.execute(queries.INSERT_RESULT_EVENTS, events_params)
     db.commit()
 
 
-def update_game_result(table_id: int, result: int, db: Session):
-    db.execute(
-        "UPDATE games SET result = :new_val WHERE game_id = :table_id",
-        {'new_val': result, 'table_id': table_id}
-    )
+# Closes abandoned tables and deletes their players, so they can play again. Nobody wins unfilled table or
+# provisioned one where nobody moved. Game which ended on the board before the clock ran out keeps that
+# result, otherwise flag fall is a loss of player to move. Returns (table_id, result) of closed tables
+def close_abandoned_tables_db(unfilled_before_ms: int, flagged_before_ms: int, db: Session) -> List[Tuple[int, int]]:
+    games_data = db.execute(
+        queries.SELECT_ABANDONED_GAMES,
+        {'no_result': Result.no_result.value, 'unfilled_before': unfilled_before_ms,
+         'flagged_before': flagged_before_ms}
+    ).fetchall()
+    closed = []
+    for data in games_data:
+        table = get_table_from_data(data)
+        if table.get_number_of_players() < 4 or table.last_move_ms is None:
+            result = Result.aborted.value
+        elif table.game_state.is_game_over():
+            result = table.game_state.get_result()
+        else:
+            result = table.get_result_color_by_nickname_of_player_flagged(table.who_to_move()).value
+        closed.append((table.table_id, result))
+    if not closed:
+        db.commit()
+        return closed
+
+    db.execute(queries.UPDATE_GAMES_RESULTS,
+               {'tables_ids': [table_id for table_id, _ in closed], 'results': [result for _, result in closed]})
+    finished_ids = [table_id for table_id, result in closed if result != Result.aborted.value]
+    if finished_ids:
+        db.execute(queries.INSERT_CLOSED_GAMES_EVENTS,
+                   {'white': Result.white.value, 'draw': Result.draw.value, 'tables_ids': finished_ids,
+                    'created_ms': now_ms()})
+    players_ids = [player_id for data in games_data for player_id in data[1:5] if player_id != -1]
+    if players_ids:
+        db.execute(queries.DELETE_PLAYERS, {'players_ids': players_ids})
+    db.commit()
+    return closed
+
+
+# Leaderboard events of finished table for the outbox relay, each player gets one event per table.
+# Returns None while game goes on
+def get_result_events_params(table: Table) -> Optional[dict]:
+    if table.get_result_value() == Result.no_result.value:
+        return None
+    results = table.get_leaderboard_results()
+    if not results:
+        return None
+    return {'table_id': table.table_id, 'nicknames': [nickname for nickname, _ in results],
+            'results': [result for _, result in results], 'created_ms': now_ms()}
+
+
+# Saves result together with its leaderboard events
+def update_game_result(table: Table, db: Session):
+    db.execute(queries.UPDATE_GAME_RESULT, {'new_val': table.get_result_value(), 'table_id': table.table_id})
+    events_params = get_result_events_params(table)
+    if events_params is not None:
+        db.execute(queries.INSERT_RESULT_EVENTS, events_params)
     db.commit()
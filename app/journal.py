@@ -0,0 +1,199 @@
+# Append-only journal of moves made on live tables held in memory. Move is written into
+# memory-mapped file before it is acknowledged, and tables are written to the database
+# only by periodic checkpoints. Journal has two fixed-size files: checkpoint switches moves
+# to the other one, saves tables and then truncates the file it has just covered.
+# Every request of a table has to reach the worker which holds it, so journal is meant for
+# single worker or sticky routing by table id. Second worker given the same journal refuses to start.
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+import app.game_server as gs
+from app.database import SessionLocal, get_engine
+
+MOVE_JOURNAL_PATH = os.getenv("MOVE_JOURNAL_PATH")
+# Number of records in each of two journal files
+JOURNAL_RECORDS = int(os.getenv("JOURNAL_RECORDS", "65536"))
+# Seconds between checkpoints to the database
+JOURNAL_CHECKPOINT_INTERVAL = float(os.getenv("JOURNAL_CHECKPOINT_INTERVAL", "5"))
+# Moves survive worker crash as soon as they are in the page cache, set to 1 to survive machine crash too
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "0") == "1"
+
+# table id, ply after the move, packed move, clock of player who moved and time of the move in milliseconds,
+# checksum of all previous fields. Empty or torn record fails the checksum.
+RECORD = struct.Struct('<IIHxxiqI')
+
+
+def get_session():
+    get_engine()
+    return SessionLocal()
+
+
+def pack_record(table_id: int, ply: int, move: int, time_left: int, move_ms: int) -> bytes:
+    fields = RECORD.pack(table_id, ply, move, time_left, move_ms, 0)[:-4]
+    return fields + struct.pack('<I', zlib.crc32(fields))
+
+
+# Returns records up to the first empty or torn one
+def read_records(mm: mmap.mmap):
+    records = []
+    for offset in range(0, len(mm), RECORD.size):
+        record = mm[offset:offset + RECORD.size]
+        table_id, ply, move, time_left, move_ms, checksum = RECORD.unpack(record)
+        if checksum != zlib.crc32(record[:-4]):
+            break
+        records.append((table_id, ply, move, time_left, move_ms))
+    return records
+
+
+class MoveJournal:
+    def __init__(self, path: str, records: int):
+        self.lock = threading.RLock()
+        self.lock_file = open(path + '.lock', 'w')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        size = records * RECORD.size
+        self.files = []
+        self.maps = []
+        for index in range(2):
+            journal_file = open('%s.%d' % (path, index), 'a+b')
+            if os.fstat(journal_file.fileno()).st_size != size:
+                journal_file.truncate(size)
+            self.files.append(journal_file)
+            self.maps.append(mmap.mmap(journal_file.fileno(), size))
+        self.active = 0
+        self.written = 0
+        self.dirty = set()
+        # (index of file waiting for truncation, ids of tables it covers) when checkpoint hasn't finished
+        self.pending = None
+
+    # Returns False when journal is full and couldn't be checkpointed, move has to be saved directly then
+    def append(self, table: gs.Table, move: int) -> bool:
+        with self.lock:
+            if self.written == JOURNAL_RECORDS:
+                self.checkpoint()
+                if self.written == JOURNAL_RECORDS:
+                    return False
+
+            pbt = table.seats[table.seat_to_move()]
+            record = pack_record(table.table_id, table.half_moves + 1, move, pbt.time_left, table.last_move_ms)
+            offset = self.written * RECORD.size
+            mm = self.maps[self.active]
+            mm[offset:offset + RECORD.size] = record
+            if JOURNAL_FSYNC:
+                page_start = offset - offset % mmap.PAGESIZE
+                mm.flush(page_start, offset + RECORD.size - page_start)
+            self.written += 1
+            self.dirty.add(table.table_id)
+            return True
+
+    # Table changed without a move, e.g. by premove, is saved by the next checkpoint
+    def mark_dirty(self, table_id: int):
+        with self.lock:
+            self.dirty.add(table_id)
+
+    def truncate(self, index: int):
+        mm = self.maps[index]
+        mm[:] = bytes(len(mm))
+        if JOURNAL_FSYNC:
+            mm.flush()
+
+    # Saves tables moved since last checkpoint and drops the journal file covering them
+    def checkpoint(self):
+        with self.lock:
+            if self.pending is None:
+                if not self.dirty:
+                    return
+                self.pending = (self.active, self.dirty)
+                self.active = 1 - self.active
+                self.written = 0
+                self.dirty = set()
+            index, tables_ids = self.pending
+            tables = [gs.LIVE_TABLES[table_id] for table_id in tables_ids if table_id in gs.LIVE_TABLES]
+            games_params, players_params, events_params = gs.get_checkpoint_params(tables)
+
+        db = get_session()
+        try:
+            gs.save_checkpoint_db(games_params, players_params, events_params, db)
+        except Exception as e:
+            print("CHECKPOINT FAILED", e)
+            return
+        finally:
+            db.close()
+
+        with self.lock:
+            self.truncate(index)
+            self.pending = None
+            # Finished tables are in the database now, unless they were moved after the switch
+            for table_id, table in list(gs.LIVE_TABLES.items()):
+                if table.get_result_value() != gs.Result.no_result.value and table_id not in self.dirty:
+                    gs.LIVE_TABLES.pop(table_id, None)
+
+    # Applies moves left from the previous run to tables loaded from the database
+    def replay(self):
+        records = read_records(self.maps[0]) + read_records(self.maps[1])
+        records.sort(key=lambda record: (record[0], record[1]))
+
+        db = get_session()
+        try:
+            replayed = 0
+            for table_id, ply, move, time_left, move_ms in records:
+                table = gs.LIVE_TABLES.get(table_id)
+                if table is None:
+                    table = gs.get_table_by_id_db(table_id, db)
+                    if table is None:
+                        continue
+                    gs.LIVE_TABLES[table_id] = table
+                # Moves already saved by a checkpoint are skipped
+                if ply != table.half_moves + 1:
+                    continue
+                table.replay_move(move, time_left, move_ms)
+                self.dirty.add(table_id)
+                replayed += 1
+        finally:
+            db.close()
+        print("REPLAYED", replayed, "MOVES FROM JOURNAL")
+
+        # Both files are saved by one checkpoint, so new moves start in an empty journal
+        self.checkpoint()
+        if self.pending is not None:
+            raise RuntimeError("Moves replayed from journal couldn't be saved to the database")
+        self.truncate(0)
+        self.truncate(1)
+
+    def run_checkpoints(self):
+        while True:
+            time.sleep(JOURNAL_CHECKPOINT_INTERVAL)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                print("CHECKPOINT FAILED", e)
+
+    def close(self):
+        self.checkpoint()
+        for mm in self.maps:
+            mm.flush()
+
+
+# Opens journal, replays it and starts checkpoints. Does nothing when journal is not configured
+# or another worker already holds it; moves of that worker are saved straight to the database.
+def open_journal():
+    if not MOVE_JOURNAL_PATH or gs.move_journal is not None:
+        return
+    try:
+        journal = MoveJournal(MOVE_JOURNAL_PATH, JOURNAL_RECORDS)
+    except BlockingIOError:
+        raise RuntimeError("MOVE_JOURNAL_PATH %s is used by another worker" % MOVE_JOURNAL_PATH) from None
+
+    journal.replay()
+    gs.move_journal = journal
+    threading.Thread(target=journal.run_checkpoints, daemon=True).start()
+
+
+def close_journal():
+    if gs.move_journal is not None:
+        gs.move_journal.close()
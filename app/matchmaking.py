@@ -0,0 +1,182 @@
+# Index of tables with free seats and quick join, which seats player in the fullest open table
+import threading
+from typing import Optional, Tuple
+
+import app.game_server as gs
+from app.clock import DEFAULT_TIME_CONTROL
+from sqlalchemy.orm import Session
+
+SEATS_PER_TABLE = 4
+# Seating attempts of one quick join before it gives up
+QUICK_JOIN_ATTEMPTS = 8
+
+# number of free seats -> ids of tables with that many free seats, not counting claimed ones
+OPEN_TABLES = {free_seats: set() for free_seats in range(1, SEATS_PER_TABLE + 1)}
+# table_id -> seats claimed by quick joins which are seating players by the table right now
+CLAIMED_SEATS = {}
+
+index_lock = threading.Lock()
+# Notified when tables created for waiting players are added to the index
+tables_created = threading.Condition(index_lock)
+index_loaded = False
+# Players in quick join who haven't claimed a seat yet, used to create tables in batches
+waiting_players = 0
+# Seats of tables being created for waiting players
+seats_being_created = 0
+
+
+def forget_table(table_id: int):
+    for tables_ids in OPEN_TABLES.values():
+        tables_ids.discard(table_id)
+
+
+def remember_open_table(table_id: int, free_seats: int):
+    forget_table(table_id)
+    free_seats -= CLAIMED_SEATS.get(table_id, 0)
+    if free_seats in OPEN_TABLES:
+        OPEN_TABLES[free_seats].add(table_id)
+
+
+def claim_seat(table_id: int):
+    CLAIMED_SEATS[table_id] = CLAIMED_SEATS.get(table_id, 0) + 1
+
+
+def release_seat(table_id: int):
+    CLAIMED_SEATS[table_id] -= 1
+    if CLAIMED_SEATS[table_id] == 0:
+        del CLAIMED_SEATS[table_id]
+
+
+# Keeps index up to date after players join or table is created. Only tables with default time control
+# are indexed, that's what quick join creates.
+def update_open_table(table: gs.Table):
+    with index_lock:
+        if table.get_result_value() != gs.Result.no_result.value or table.time_control != DEFAULT_TIME_CONTROL:
+            forget_table(table.table_id)
+        else:
+            remember_open_table(table.table_id, SEATS_PER_TABLE - table.get_number_of_players())
+
+
+def add_created_table(table_id: int):
+    with index_lock:
+        remember_open_table(table_id, SEATS_PER_TABLE - 1)
+
+
+def load_open_tables(open_tables):
+    global index_loaded
+    for table_id, free_seats in open_tables:
+        remember_open_table(table_id, free_seats)
+    index_loaded = True
+
+
+def get_number_of_open_seats() -> int:
+    return sum(free_seats * len(tables_ids) for free_seats, tables_ids in OPEN_TABLES.items())
+
+
+# Claims one seat of the fullest open table, so players joining at the same time go to different seats.
+# try_to_seat releases the claim.
+def claim_open_table() -> Optional[int]:
+    global waiting_players
+    with index_lock:
+        while True:
+            for free_seats in range(1, SEATS_PER_TABLE + 1):
+                for table_id in sorted(OPEN_TABLES[free_seats]):
+                    forget_table(table_id)
+                    if free_seats > 1:
+                        OPEN_TABLES[free_seats - 1].add(table_id)
+                    claim_seat(table_id)
+                    waiting_players -= 1
+                    return table_id
+            if seats_being_created == 0:
+                return None
+            tables_created.wait()
+
+
+# More players waiting than free seats, creates enough tables for all of them at once
+def create_missing_tables(db: Session):
+    global seats_being_created
+    with index_lock:
+        missing_seats = waiting_players - get_number_of_open_seats() - seats_being_created
+        if missing_seats <= 0:
+            return
+        tables_to_create = (missing_seats + SEATS_PER_TABLE - 1) // SEATS_PER_TABLE
+        seats_being_created += tables_to_create * SEATS_PER_TABLE
+
+    created_ids = []
+    try:
+        created_ids = gs.create_empty_tables_db(tables_to_create, db)
+    finally:
+        with index_lock:
+            seats_being_created -= tables_to_create * SEATS_PER_TABLE
+            for table_id in created_ids:
+                remember_open_table(table_id, SEATS_PER_TABLE)
+            tables_created.notify_all()
+
+
+# Returns (table, whether game started) or None when player couldn't be seated by the table,
+# seat by the table has to be claimed first
+def try_to_seat(table_id: int, nickname: str, token: str, db: Session) -> Optional[Tuple[gs.Table, bool]]:
+    # Closed tables are dropped from the index
+    free_seats = 0
+    seated = None
+    try:
+        table = gs.get_table_by_id(table_id, db)
+        if table is None or table.get_result_value() != gs.Result.no_result.value:
+            return None
+
+        free_seats = SEATS_PER_TABLE - table.get_number_of_players()
+        if free_seats == 0 or nickname in table.seat_by_nickname:
+            return None
+
+        if table.add_player(nickname, token, db):
+            seated = table, table.start_game(db)
+            free_seats = SEATS_PER_TABLE - table.get_number_of_players()
+        else:
+            # Seat got taken by another worker in the meantime
+            free_seats -= 1
+        return seated
+    finally:
+        with index_lock:
+            release_seat(table_id)
+            remember_open_table(table_id, free_seats)
+
+
+# Seats player in the fullest open table, returns (table, whether game started) or None.
+# Index lock is held only to pick a table, database is queried outside of it.
+def quick_join(nickname: str, token: str, db: Session) -> Optional[Tuple[gs.Table, bool]]:
+    global waiting_players
+    if gs.get_player_id_from_db(nickname, token, db) != -1:
+        return None
+
+    if not index_loaded:
+        open_tables = gs.get_open_tables_db(db)
+        with index_lock:
+            if not index_loaded:
+                load_open_tables(open_tables)
+
+    with index_lock:
+        waiting_players += 1
+    waiting = True
+    try:
+        for _ in range(QUICK_JOIN_ATTEMPTS):
+            create_missing_tables(db)
+            table_id = claim_open_table()
+            if table_id is None:
+                # Every table we knew about is full by now
+                table_id = gs.create_empty_tables_db(1, db)[0]
+                with index_lock:
+                    claim_seat(table_id)
+                    waiting_players -= 1
+            waiting = False
+
+            seated = try_to_seat(table_id, nickname, token, db)
+            if seated is not None:
+                return seated
+            with index_lock:
+                waiting_players += 1
+            waiting = True
+        return None
+    finally:
+        if waiting:
+            with index_lock:
+                waiting_players -= 1
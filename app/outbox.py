@@ -0,0 +1,119 @@
+# Relay publishing leaderboard events from the outbox table. Events are saved in the same transaction
+# as the game result, so a request never waits for the broker and no result is lost when broker is down.
+# Event is marked as sent only after broker confirmed it, so it may be published more than once;
+# message_id is the same on every attempt and lets consumer drop duplicates.
+import json
+import os
+import threading
+import time
+
+import app.queries as queries
+from app.clock import now_ms
+from app.database import SessionLocal, get_engine
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "34.118.13.126")
+RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", "5672"))
+RABBITMQ_USER = os.getenv("RABBITMQ_USER", "rabbit")
+RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD", "HyLU1eKw42oI")
+EXCHANGE = 'message-exchange'
+QUEUE = 'update-leaderboard'
+
+# Events published in one batch
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+# Seconds between relay runs when outbox is empty, 0 turns relay off
+OUTBOX_RELAY_INTERVAL = float(os.getenv("OUTBOX_RELAY_INTERVAL", "1"))
+
+relay_started = False
+
+
+def get_broker_parameters():
+    # Imported here, broker client is needed only by background threads
+    import pika
+
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
+    return pika.ConnectionParameters(RABBITMQ_HOST, RABBITMQ_PORT, '/', credentials, heartbeat=0)
+
+
+class BrokerChannel:
+    __slots__ = ('connection', 'channel')
+
+    def __init__(self):
+        self.connection = None
+        self.channel = None
+
+    def get_channel(self):
+        if self.channel is not None and self.channel.is_open:
+            return self.channel
+        self.close()
+
+        import pika
+
+        self.connection = pika.BlockingConnection(get_broker_parameters())
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+        self.channel.exchange_declare(exchange=EXCHANGE, exchange_type='fanout')
+        self.channel.queue_declare(queue=QUEUE, durable=True)
+        self.channel.queue_bind(exchange=EXCHANGE, queue=QUEUE)
+        return self.channel
+
+    def publish(self, events):
+        import pika
+
+        channel = self.get_channel()
+        for event_id, table_id, nickname, result in events:
+            properties = pika.BasicProperties(message_id='result-%d-%s' % (table_id, nickname), delivery_mode=2,
+                                              content_type='application/json')
+            # Raises when broker doesn't confirm the message
+            channel.basic_publish(exchange=EXCHANGE, routing_key=QUEUE, properties=properties,
+                                  body=json.dumps({'nickname': nickname, 'result': result}))
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+        self.channel = None
+
+
+# Publishes one batch of unsent events, returns how many were sent
+def relay_batch(broker: BrokerChannel) -> int:
+    get_engine()
+    db = SessionLocal()
+    try:
+        events = db.execute(queries.SELECT_UNSENT_EVENTS, {'limit': OUTBOX_BATCH_SIZE}).fetchall()
+        if not events:
+            db.rollback()
+            return 0
+        broker.publish(events)
+        db.execute(queries.MARK_EVENTS_SENT, {'sent_ms': now_ms(), 'events_ids': [event[0] for event in events]})
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    print("PUBLISHED", len(events), "LEADERBOARD EVENTS")
+    return len(events)
+
+
+def run_relay():
+    broker = BrokerChannel()
+    while True:
+        try:
+            # Full batch means more events are probably waiting
+            if relay_batch(broker) == OUTBOX_BATCH_SIZE:
+                continue
+        except Exception as e:
+            print("OUTBOX RELAY FAILED", e)
+            broker.close()
+        time.sleep(OUTBOX_RELAY_INTERVAL)
+
+
+def start_relay():
+    global relay_started
+    if OUTBOX_RELAY_INTERVAL <= 0 or relay_started:
+        return
+    relay_started = True
+    threading.Thread(target=run_relay, daemon=True).start()
@@ -0,0 +1,133 @@
+# SQL statements used by game server. They are built once at import, so SQLAlchemy parses each of them
+# only once and reuses its compiled form from the engine's cache for every request.
+from sqlalchemy import text
+
+SEAT_COLUMNS = ['white_one_id', 'white_two_id', 'black_one_id', 'black_two_id']
+GAME_COLUMNS = "game_id, white_one_id, white_two_id, black_one_id, black_two_id, halfmoves, " \
+               "result, game_start_ms, last_move_ms, fen, position_hashes, base_time_ms, increment_ms, delay_ms"
+# Same layout without position, for endpoints which never look at the board
+BOARDLESS_GAME_COLUMNS = "game_id, white_one_id, white_two_id, black_one_id, black_two_id, halfmoves, result, " \
+                         "game_start_ms, last_move_ms, NULL AS fen, NULL AS position_hashes, base_time_ms, " \
+                         "increment_ms, delay_ms"
+# Game joined with players of its four seats, so table is loaded in one round trip. Nickname, token, clock and
+# premove of every seat follow game columns, they are empty when seat is free or player was deleted.
+SEAT_ALIASES = ['white_one', 'white_two', 'black_one', 'black_two']
+SEAT_PLAYER_COLUMNS = "".join(f", {alias}.nickname, {alias}.token, {alias}.time_left_ms, {alias}.premove"
+                              for alias in SEAT_ALIASES)
+SEATED_GAME_COLUMNS = GAME_COLUMNS + SEAT_PLAYER_COLUMNS
+SEATED_GAMES = "games" + "".join(f" LEFT JOIN players {alias} ON {alias}.player_id = games.{column}"
+                                 for alias, column in zip(SEAT_ALIASES, SEAT_COLUMNS))
+
+# Players
+INSERT_PLAYER = text(
+    "INSERT INTO players (nickname, token, time_left_ms) VALUES (:nickname, :token, :time_left_ms) "
+    "RETURNING player_id")
+
+SELECT_PLAYER_ID = text("SELECT player_id FROM players WHERE nickname = :nickname AND token = :token")
+
+SELECT_ANY_OF_PLAYERS = text(
+    "SELECT 1 FROM players JOIN unnest(CAST(:nicknames AS varchar[]), CAST(:tokens AS varchar[])) "
+    "AS new_players(nickname, token) USING (nickname, token) LIMIT 1")
+
+INSERT_PLAYERS = text(
+    "INSERT INTO players (nickname, token, time_left_ms) SELECT nickname, token, :time_left_ms FROM "
+    "unnest(CAST(:nicknames AS varchar[]), CAST(:tokens AS varchar[])) AS new_players(nickname, token) "
+    "RETURNING player_id, nickname, token")
+
+DELETE_PLAYER = text("DELETE FROM players WHERE player_id = :player_id")
+
+DELETE_PLAYERS = text("DELETE FROM players WHERE player_id = ANY(:players_ids)")
+
+UPDATE_PLAYER_TIME = text(
+    "UPDATE players SET time_left_ms = :time_left_ms, premove = :premove WHERE player_id = :player_id")
+
+UPDATE_PLAYER_PREMOVE = text("UPDATE players SET premove = :premove WHERE player_id = :player_id")
+
+# Games
+INSERT_GAME = text(
+    "INSERT INTO games (white_one_id, white_two_id, black_one_id, black_two_id, halfmoves, result, game_start_ms, "
+    "last_move_ms, fen, base_time_ms, increment_ms, delay_ms) VALUES (:woid, :wtid, :boid, :btid, :halfmoves, "
+    ":result, :start_ms, :start_ms, :fen, :base_time_ms, :increment_ms, :delay_ms) RETURNING game_id")
+
+INSERT_FULL_GAMES = text(
+    "INSERT INTO games (white_one_id, white_two_id, black_one_id, black_two_id, halfmoves, result, game_start_ms, "
+    "last_move_ms, fen, base_time_ms, increment_ms, delay_ms) SELECT woid, wtid, boid, btid, 0, :result, "
+    ":start_ms, NULL, :fen, :base_time_ms, :increment_ms, :delay_ms FROM unnest(CAST(:woids AS integer[]), "
+    "CAST(:wtids AS integer[]), CAST(:boids AS integer[]), CAST(:btids AS integer[])) AS seats(woid, wtid, boid, btid) "
+    "RETURNING game_id, white_one_id")
+
+INSERT_EMPTY_GAMES = text(
+    "INSERT INTO games (white_one_id, white_two_id, black_one_id, black_two_id, halfmoves, result, game_start_ms, "
+    "last_move_ms, fen, base_time_ms, increment_ms, delay_ms) SELECT -1, -1, -1, -1, 0, :result, :start_ms, "
+    ":start_ms, :fen, :base_time_ms, :increment_ms, :delay_ms FROM generate_series(1, :count) RETURNING game_id")
+
+SELECT_GAME = text(f"SELECT {SEATED_GAME_COLUMNS} FROM {SEATED_GAMES} WHERE game_id = :table_id")
+
+# Locks games row before the table is loaded by SELECT_GAME. Separate statement is needed: statement waiting
+# for the lock would still see players as they were when it started, without premove saved meanwhile.
+LOCK_GAME = text("SELECT 1 FROM games WHERE game_id = :table_id FOR UPDATE")
+
+SELECT_BOARDLESS_GAME = text(
+    f"SELECT {BOARDLESS_GAME_COLUMNS}{SEAT_PLAYER_COLUMNS} FROM {SEATED_GAMES} WHERE game_id = :table_id")
+
+SELECT_GAMES_BY_IDS = text(
+    f"SELECT {SEATED_GAME_COLUMNS} FROM {SEATED_GAMES} WHERE game_id = ANY(:table_ids) ORDER BY game_id")
+
+SELECT_LIVE_GAMES = text(
+    f"SELECT {SEATED_GAME_COLUMNS} FROM {SEATED_GAMES} WHERE result = :no_result ORDER BY game_id "
+    "LIMIT :limit OFFSET :offset")
+
+SELECT_OPEN_GAMES = text(
+    "SELECT game_id, (white_one_id = -1)::int + (white_two_id = -1)::int + (black_one_id = -1)::int "
+    "+ (black_two_id = -1)::int AS free_seats FROM games WHERE result = :no_result AND "
+    "(white_one_id = -1 OR white_two_id = -1 OR black_one_id = -1 OR black_two_id = -1) AND "
+    "base_time_ms = :base_time_ms AND increment_ms = :increment_ms AND delay_ms = :delay_ms")
+
+# Seat is taken only if it is still free, so concurrent joins can't overwrite each other
+TAKE_SEAT = [text(f"UPDATE games SET {column} = :new_value WHERE game_id = :table_id AND {column} = -1")
+             for column in SEAT_COLUMNS]
+
+START_GAME = text("UPDATE games SET game_start_ms = :start_ms, last_move_ms = :start_ms WHERE game_id = :table_id")
+
+UPDATE_GAME_AFTER_MOVE = text(
+    "UPDATE games SET fen = :fen, halfmoves = :halfmoves, result = :result, game_start_ms = :game_start_ms, "
+    "last_move_ms = :last_move_ms, position_hashes = CAST(:position_hashes AS bigint[]) WHERE game_id = :table_id")
+
+UPDATE_GAME_RESULT = text("UPDATE games SET result = :new_val WHERE game_id = :table_id")
+
+# Outbox of leaderboard events
+INSERT_RESULT_EVENTS = text(
+    "INSERT INTO outbox (table_id, nickname, result, created_ms) SELECT :table_id, nickname, result, :created_ms "
+    "FROM unnest(CAST(:nicknames AS varchar[]), CAST(:results AS varchar[])) AS events(nickname, result) "
+    "ON CONFLICT (table_id, nickname) DO NOTHING")
+
+# Rows locked by relay of another worker are skipped, so every event is taken by one relay at a time
+SELECT_UNSENT_EVENTS = text(
+    "SELECT event_id, table_id, nickname, result FROM outbox WHERE sent_ms IS NULL ORDER BY event_id "
+    "LIMIT :limit FOR UPDATE SKIP LOCKED")
+
+MARK_EVENTS_SENT = text("UPDATE outbox SET sent_ms = :sent_ms WHERE event_id = ANY(:events_ids)")
+
+# Tables which didn't fill up and started games where player to move ran out of time long ago, with their
+# players. Rows being moved on are skipped, reaper takes them next time.
+FULL_TABLE = "white_one_id <> -1 AND white_two_id <> -1 AND black_one_id <> -1 AND black_two_id <> -1"
+PLAYER_TO_MOVE_ID = "CASE halfmoves % 4 WHEN 0 THEN white_one_id WHEN 1 THEN black_one_id " \
+                    "WHEN 2 THEN white_two_id ELSE black_two_id END"
+SELECT_ABANDONED_GAMES = text(
+    f"SELECT {SEATED_GAME_COLUMNS} FROM {SEATED_GAMES} WHERE games.result = :no_result AND "
+    f"(((NOT ({FULL_TABLE}) OR last_move_ms IS NULL) AND game_start_ms < :unfilled_before) OR "
+    f"({FULL_TABLE} AND last_move_ms + delay_ms + "
+    f"(SELECT time_left_ms FROM players WHERE player_id = {PLAYER_TO_MOVE_ID}) < :flagged_before)) "
+    "FOR UPDATE OF games SKIP LOCKED")
+
+UPDATE_GAMES_RESULTS = text(
+    "UPDATE games SET result = closed.result FROM unnest(CAST(:tables_ids AS integer[]), "
+    "CAST(:results AS integer[])) AS closed(game_id, result) WHERE games.game_id = closed.game_id")
+
+# Leaderboard events of closed games, written before their players are deleted
+INSERT_CLOSED_GAMES_EVENTS = text(
+    "INSERT INTO outbox (table_id, nickname, result, created_ms) SELECT game_id, nickname, "
+    "CASE WHEN result = :draw THEN 'draw' "
+    "WHEN (player_id IN (white_one_id, white_two_id)) = (result = :white) THEN 'won' ELSE 'lost' END, "
+    ":created_ms FROM games JOIN players ON player_id IN (white_one_id, white_two_id, black_one_id, black_two_id) "
+    "WHERE game_id = ANY(:tables_ids) ON CONFLICT (table_id, nickname) DO NOTHING")
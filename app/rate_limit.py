@@ -0,0 +1,119 @@
+# In-memory token buckets limiting how often a player, a client or a table may hit hot endpoints.
+# Moves and reads have separate budgets. Request over the limit is refused with Retry-After telling
+# when the next one will be admitted. Reads and moves with seat token are refused before they touch
+# the database, moves with nickname and token once the table has confirmed them.
+import hmac
+import math
+import os
+import threading
+import time
+from typing import Optional
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# Requests per second and burst size of each bucket
+PLAYER_MOVE_RATE = float(os.getenv("PLAYER_MOVE_RATE", "2"))
+PLAYER_MOVE_BURST = float(os.getenv("PLAYER_MOVE_BURST", "5"))
+TABLE_MOVE_RATE = float(os.getenv("TABLE_MOVE_RATE", "8"))
+TABLE_MOVE_BURST = float(os.getenv("TABLE_MOVE_BURST", "16"))
+CLIENT_READ_RATE = float(os.getenv("CLIENT_READ_RATE", "20"))
+CLIENT_READ_BURST = float(os.getenv("CLIENT_READ_BURST", "40"))
+TABLE_READ_RATE = float(os.getenv("TABLE_READ_RATE", "200"))
+TABLE_READ_BURST = float(os.getenv("TABLE_READ_BURST", "400"))
+# Buckets kept by each limiter, idle ones are dropped above it
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Proxies in front of the worker which append address of their peer to X-Forwarded-For. Reads are limited
+# per address of the client seen by the outermost of them; 0 means clients connect directly.
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+# Keys with most refused requests reported by counters
+RATE_LIMIT_TOP_KEYS = 20
+# Counters name client addresses and seats, so they are shown only to requests carrying this token.
+# Unset hides them altogether.
+RATE_LIMITS_ADMIN_TOKEN = os.getenv("RATE_LIMITS_ADMIN_TOKEN")
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated', 'allowed', 'refused')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.allowed = 0
+        self.refused = 0
+
+
+class RateLimiter:
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.refused = 0
+
+    # Returns 0 when request is admitted, otherwise seconds until it would be
+    def acquire(self, key) -> float:
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= RATE_LIMIT_MAX_KEYS:
+                    self.drop_idle_buckets(now)
+                bucket = TokenBucket(self.burst, now)
+                self.buckets[key] = bucket
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                bucket.allowed += 1
+                self.allowed += 1
+                return 0.0
+            bucket.refused += 1
+            self.refused += 1
+            return (1 - bucket.tokens) / self.rate
+
+    # Full bucket behaves the same as a new one, so it can be forgotten
+    def drop_idle_buckets(self, now: float):
+        idle_for = self.burst / self.rate
+        for key in [key for key, bucket in self.buckets.items() if now - bucket.updated >= idle_for]:
+            del self.buckets[key]
+
+    def get_counters(self):
+        with self.lock:
+            top = sorted(self.buckets.items(), key=lambda item: item[1].refused, reverse=True)[:RATE_LIMIT_TOP_KEYS]
+            return {'allowed': self.allowed, 'refused': self.refused, 'keys': len(self.buckets),
+                    'top_refused': {str(key): {'allowed': bucket.allowed, 'refused': bucket.refused}
+                                    for key, bucket in top if bucket.refused}}
+
+
+PLAYER_MOVES = RateLimiter('player_moves', PLAYER_MOVE_RATE, PLAYER_MOVE_BURST)
+TABLE_MOVES = RateLimiter('table_moves', TABLE_MOVE_RATE, TABLE_MOVE_BURST)
+CLIENT_READS = RateLimiter('client_reads', CLIENT_READ_RATE, CLIENT_READ_BURST)
+TABLE_READS = RateLimiter('table_reads', TABLE_READ_RATE, TABLE_READ_BURST)
+LIMITERS = [PLAYER_MOVES, TABLE_MOVES, CLIENT_READS, TABLE_READS]
+
+
+# Returns seconds to wait when any of (limiter, key) pairs refuses the request, 0 when all admit it
+def get_retry_after(checks) -> float:
+    if not RATE_LIMIT_ENABLED:
+        return 0.0
+    for limiter, key in checks:
+        retry_after = limiter.acquire(key)
+        if retry_after:
+            return retry_after
+    return 0.0
+
+
+def get_retry_after_header(retry_after: float) -> str:
+    return str(max(1, math.ceil(retry_after)))
+
+
+def is_admin_token(token: Optional[str]) -> bool:
+    return bool(RATE_LIMITS_ADMIN_TOKEN) and token is not None and \
+        hmac.compare_digest(token.encode(), RATE_LIMITS_ADMIN_TOKEN.encode())
+
+
+def get_counters():
+    return {limiter.name: limiter.get_counters() for limiter in LIMITERS}
@@ -0,0 +1,70 @@
+# Background reaper closing tables nobody plays at anymore: tables which didn't get four players
+# in UNFILLED_TABLE_TTL seconds are aborted, and started games where player to move ran out of time
+# IDLE_TABLE_TTL seconds ago are lost by that player, unless mate or draw on the board ended them first.
+# Games with time left on the clock are never closed, however long it is. Players are deleted, so the same
+# nickname and token can join another table.
+import os
+import threading
+import time
+
+import app.cache as cache
+import app.events as events
+import app.game_server as gs
+import app.matchmaking as matchmaking
+from app.clock import now_ms, seconds_to_ms
+from app.database import SessionLocal, get_engine
+
+UNFILLED_TABLE_TTL = float(os.getenv("UNFILLED_TABLE_TTL", "900"))
+IDLE_TABLE_TTL = float(os.getenv("IDLE_TABLE_TTL", "3600"))
+# Seconds between runs, 0 turns reaper off
+REAPER_INTERVAL = float(os.getenv("REAPER_INTERVAL", "60"))
+
+reaper_started = False
+
+
+def evict_table(table_id: int, result: int):
+    cache.forget_table(table_id)
+    with matchmaking.index_lock:
+        matchmaking.forget_table(table_id)
+
+    # Table held in memory must not be moved or checkpointed as live anymore
+    if gs.move_journal is not None:
+        with gs.move_journal.lock:
+            table = gs.LIVE_TABLES.pop(table_id, None)
+            if table is not None:
+                table.result = gs.Result(result)
+
+
+def reap_tables() -> int:
+    now = now_ms()
+    get_engine()
+    db = SessionLocal()
+    try:
+        closed = gs.close_abandoned_tables_db(now - seconds_to_ms(UNFILLED_TABLE_TTL),
+                                              now - seconds_to_ms(IDLE_TABLE_TTL), db)
+    finally:
+        db.close()
+
+    for table_id, result in closed:
+        evict_table(table_id, result)
+        events.publish_event(table_id, events.EVENT_RESULT)
+    if closed:
+        print("REAPED", len(closed), "TABLES")
+    return len(closed)
+
+
+def run_reaper():
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        try:
+            reap_tables()
+        except Exception as e:
+            print("REAPER FAILED", e)
+
+
+def start_reaper():
+    global reaper_started
+    if REAPER_INTERVAL <= 0 or reaper_started:
+        return
+    reaper_started = True
+    threading.Thread(target=run_reaper, daemon=True).start()
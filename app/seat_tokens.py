@@ -0,0 +1,43 @@
+# Signed seat tokens handed out on create and join. Token says which seat of which table its holder
+# sits on and until when, so a move is authorised by checking the signature in memory instead of
+# comparing credentials of the player. Format: table_id.seat.expiry_seconds.signature
+import base64
+import hashlib
+import hmac
+import os
+from typing import Optional
+
+from app.clock import now_ms
+
+# Shared by all workers, token signed by one of them is checked by another
+SEAT_TOKEN_SECRET = os.getenv("SEAT_TOKEN_SECRET", "")
+# Seconds for which token is valid
+SEAT_TOKEN_TTL = int(os.getenv("SEAT_TOKEN_TTL", str(6 * 60 * 60)))
+# Bytes of HMAC-SHA256 kept in the token
+SIGNATURE_SIZE = 16
+
+# Random key of each worker would refuse tokens issued by the others, so worker doesn't start without it
+if not SEAT_TOKEN_SECRET:
+    raise RuntimeError("SEAT_TOKEN_SECRET is not set")
+secret_key = SEAT_TOKEN_SECRET.encode()
+
+
+def sign(payload: str) -> str:
+    digest = hmac.new(secret_key, payload.encode(), hashlib.sha256).digest()[:SIGNATURE_SIZE]
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def create_seat_token(table_id: int, seat: int) -> str:
+    payload = '%d.%d.%d' % (table_id, seat, now_ms() // 1000 + SEAT_TOKEN_TTL)
+    return payload + '.' + sign(payload)
+
+
+# Returns seat the token was issued for, None when token is forged, expired or belongs to other table
+def get_seat_from_token(seat_token: str, table_id: int) -> Optional[int]:
+    payload, _, signature = seat_token.rpartition('.')
+    if not hmac.compare_digest(sign(payload).encode(), signature.encode()):
+        return None
+    token_table_id, seat, expiry = (int(field) for field in payload.split('.'))
+    if token_table_id != table_id or expiry < now_ms() // 1000:
+        return None
+    return seat
@@ -0,0 +1,152 @@
+# Hub streaming table states to spectators as server-sent events. Every table version is encoded into
+# one frame, and the same bytes are handed to all subscribers of the table. Each subscriber has a short
+# queue which drops the oldest frames, so a slow connection skips intermediate states instead of
+# piling them up. Cost of spectators grows with moves, not with number of viewers.
+import asyncio
+import os
+from collections import deque
+from typing import Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+import app.waiters as waiters
+from app.cache import get_etag, get_state_payload
+from app.game_server import Result
+
+# Frames kept for subscriber which doesn't read fast enough, older ones are dropped
+SPECTATOR_QUEUE_SIZE = int(os.getenv("SPECTATOR_QUEUE_SIZE", "2"))
+MAX_SPECTATORS_PER_TABLE = int(os.getenv("MAX_SPECTATORS_PER_TABLE", "1000"))
+# Seconds between keep-alive comments, proxies close idle connections
+SPECTATOR_KEEPALIVE = float(os.getenv("SPECTATOR_KEEPALIVE", "15"))
+# Seconds between checks of tables changed by other workers, 0 turns checks off
+SPECTATOR_RECHECK_INTERVAL = float(os.getenv("SPECTATOR_RECHECK_INTERVAL", "2"))
+
+KEEPALIVE_FRAME = b": keepalive\n\n"
+
+# table_id -> set of subscribers, touched only from the event loop
+SUBSCRIBERS = {}
+# table_id -> etag of the last frame sent to subscribers
+LAST_ETAGS = {}
+loop = None
+recheck_task = None
+
+
+class Subscriber:
+    __slots__ = ('frames', 'event')
+
+    def __init__(self):
+        self.frames = deque(maxlen=SPECTATOR_QUEUE_SIZE)
+        self.event = asyncio.Event()
+
+    # Frame is queued with flag telling whether it is the last state of the game
+    def push(self, frame: bytes, finished: bool):
+        self.frames.append((frame, finished))
+        self.event.set()
+
+    async def get_frame(self) -> Tuple[bytes, bool]:
+        if not self.frames:
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), SPECTATOR_KEEPALIVE)
+            except asyncio.TimeoutError:
+                return KEEPALIVE_FRAME, False
+        return self.frames.popleft()
+
+
+def is_finished(table) -> bool:
+    return table.get_result_value() != Result.no_result.value
+
+
+# Encodes table once for all subscribers, returns (etag, frame, whether game is finished) of one version
+def get_frame(table) -> Tuple[str, bytes, bool]:
+    with table.lock():
+        etag = get_etag(table)
+        frame = b"id: " + etag.strip('"').encode() + b"\nevent: state\ndata: " + get_state_payload(table) + b"\n\n"
+        return etag, frame, is_finished(table)
+
+
+# Frames are built in request threads, live table can be locked by a move
+def load_frames(tables_ids):
+    return [(table.table_id, *get_frame(table)) for table in waiters.load_tables(tables_ids)]
+
+
+def load_frame(table_id: int):
+    table = waiters.load_table(table_id)
+    return get_frame(table) if table is not None else None
+
+
+def broadcast(table_id: int, etag: str, frame: bytes, finished: bool):
+    if LAST_ETAGS.get(table_id) == etag:
+        return
+    LAST_ETAGS[table_id] = etag
+    for subscriber in SUBSCRIBERS.get(table_id, ()):
+        subscriber.push(frame, finished)
+
+
+# Called from request threads after table was changed
+def publish(table):
+    if loop is not None and table.table_id in SUBSCRIBERS:
+        loop.call_soon_threadsafe(broadcast, table.table_id, *get_frame(table))
+
+
+async def recheck_watched_tables():
+    while True:
+        await asyncio.sleep(SPECTATOR_RECHECK_INTERVAL)
+        if not SUBSCRIBERS:
+            continue
+        try:
+            frames = await run_in_threadpool(load_frames, list(SUBSCRIBERS))
+        except Exception as e:
+            print("SPECTATOR RECHECK FAILED", e)
+            continue
+        for table_id, etag, frame, finished in frames:
+            broadcast(table_id, etag, frame, finished)
+
+
+# Returns subscriber with current state queued, None when table doesn't exist or has too many spectators
+async def subscribe(table_id: int):
+    global loop, recheck_task
+    loop = asyncio.get_running_loop()
+    if SPECTATOR_RECHECK_INTERVAL > 0 and (recheck_task is None or recheck_task.get_loop() is not loop):
+        recheck_task = loop.create_task(recheck_watched_tables())
+
+    if len(SUBSCRIBERS.get(table_id, ())) >= MAX_SPECTATORS_PER_TABLE:
+        return None
+    # Subscribed before loading, so a change made meanwhile is not missed
+    subscriber = Subscriber()
+    SUBSCRIBERS.setdefault(table_id, set()).add(subscriber)
+    try:
+        loaded = await run_in_threadpool(load_frame, table_id)
+    except Exception:
+        unsubscribe(table_id, subscriber)
+        raise
+    if loaded is None:
+        unsubscribe(table_id, subscriber)
+        return None
+
+    etag, frame, finished = loaded
+    if not subscriber.frames:
+        subscriber.push(frame, finished)
+    LAST_ETAGS.setdefault(table_id, etag)
+    return subscriber
+
+
+def unsubscribe(table_id: int, subscriber: Subscriber):
+    subscribers = SUBSCRIBERS.get(table_id)
+    if subscribers is not None:
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del SUBSCRIBERS[table_id]
+            LAST_ETAGS.pop(table_id, None)
+
+
+# Yields frames until game has a result and its last frame is sent or spectator disconnects
+async def stream(table_id: int, subscriber: Subscriber):
+    try:
+        while True:
+            frame, finished = await subscriber.get_frame()
+            yield frame
+            if finished:
+                return
+    finally:
+        unsubscribe(table_id, subscriber)
@@ -1,12 +1,186 @@
-from fastapi.responses import JSONResponse
+import math
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import app.events as events
 import app.game_server as gs
-from .database import get_db
-from fastapi import APIRouter, Depends, HTTPException, status
+import app.matchmaking as matchmaking
+import app.rate_limit as rate_limit
+import app.seat_tokens as seat_tokens
+import app.spectators as spectators
+import app.waiters as waiters
+from .cache import get_etag, get_state_payload, get_unmodified_etag, remember_version
+from .clock import DEFAULT_BASE_TIME, DEFAULT_DELAY, DEFAULT_INCREMENT, DEFAULT_TIME_CONTROL
+from .clock import TimeControl, get_time_control, ms_to_iso
+from .database import SQLALCHEMY_READ_REPLICA_URL, get_db, get_read_db
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
+from typing import List, Optional, Tuple
 
 router = APIRouter()
 
 
+# Answers conditional GET from the in-memory version map, without touching the database
+def not_modified(table_id: int, if_none_match: Optional[str]):
+    etag = get_unmodified_etag(table_id, if_none_match)
+    if etag is not None:
+        return Response(status_code=304, headers={'ETag': etag})
+    return None
+
+
+# Refuses request over the rate limit before it reaches the database
+def too_many_requests(checks):
+    retry_after = rate_limit.get_retry_after(checks)
+    if retry_after:
+        return JSONResponse(status_code=429, content="Too many requests",
+                            headers={'Retry-After': rate_limit.get_retry_after_header(retry_after)})
+    return None
+
+
+# Behind load balancer every request comes from its address, so client is taken from X-Forwarded-For.
+# Only entries added by trusted proxies are used, the ones before them are sent by the client itself.
+def get_client_key(request: Request):
+    if rate_limit.RATE_LIMIT_TRUSTED_PROXIES > 0:
+        forwarded_for = [address.strip() for address in request.headers.get('x-forwarded-for', '').split(',')
+                         if address.strip()]
+        if forwarded_for:
+            return forwarded_for[-min(rate_limit.RATE_LIMIT_TRUSTED_PROXIES, len(forwarded_for))]
+    return request.client.host if request.client is not None else None
+
+
+def read_limits(table_id: int, request: Request):
+    return [(rate_limit.CLIENT_READS, get_client_key(request)), (rate_limit.TABLE_READS, table_id)]
+
+
+# Replica may lag behind primary, so versions read from it are not put into the version map,
+# otherwise an older version could shadow the one remembered after a move
+def read_etag(table: gs.Table) -> str:
+    if SQLALCHEMY_READ_REPLICA_URL:
+        return get_etag(table)
+    return remember_version(table)
+
+
+# Remembers new version of the table, wakes requests waiting for it, sends it to spectators
+# and tells other workers about the event
+def table_changed(table: gs.Table, event: str) -> str:
+    etag = remember_version(table)
+    waiters.notify_table_changed(table)
+    spectators.publish(table)
+    events.publish_event(table.table_id, event)
+    return etag
+
+
+MAX_TABLES_PER_BATCH = 100
+
+
+def tables_payload(tables) -> bytes:
+    return b'[' + b','.join(get_state_payload(table) for table in tables) + b']'
+
+
+# Returns states of many tables at once, ids is comma separated list of table ids
+@router.get("/tables/batch")
+def get_tables_batch(ids: str, request: Request, db: Session = Depends(get_read_db)):
+    res = too_many_requests([(rate_limit.CLIENT_READS, get_client_key(request))])
+    if res is not None:
+        return res
+    try:
+        table_ids = [int(table_id) for table_id in ids.split(',') if table_id.strip()]
+    except ValueError:
+        return JSONResponse(status_code=400, content="Table ids must be integers")
+    if not table_ids or len(table_ids) > MAX_TABLES_PER_BATCH:
+        return JSONResponse(status_code=400, content="Ask for 1 to %d tables" % MAX_TABLES_PER_BATCH)
+
+    tables = gs.get_tables_by_ids_db(table_ids, db)
+    return Response(status_code=200, content=tables_payload(tables), media_type="application/json")
+
+
+# Returns states of page of tables which game has not finished yet
+@router.get("/tables/live")
+def get_live_tables(request: Request, offset: int = 0, limit: int = 20, db: Session = Depends(get_read_db)):
+    res = too_many_requests([(rate_limit.CLIENT_READS, get_client_key(request))])
+    if res is not None:
+        return res
+    if offset < 0 or not 0 < limit <= MAX_TABLES_PER_BATCH:
+        return JSONResponse(status_code=400, content="Limit must be between 1 and %d" % MAX_TABLES_PER_BATCH)
+
+    tables = gs.get_live_tables_db(offset, limit, db)
+    return Response(status_code=200, content=tables_payload(tables), media_type="application/json")
+
+
+MAX_TABLES_PER_BULK = 500
+
+
+class SeatRequest(BaseModel):
+    nickname: str
+    token: str
+
+
+class BulkTablesRequest(BaseModel):
+    # Every table is list of 4 seats: white one, white two, black one, black two
+    tables: List[List[SeatRequest]]
+    # Time control of all the tables, in seconds
+    base_time: float = DEFAULT_BASE_TIME
+    increment: float = DEFAULT_INCREMENT
+    delay: float = DEFAULT_DELAY
+
+
+INVALID_TIME_CONTROL = "Base time must be positive and at most a day, increment and delay between 0 and 10 minutes"
+
+
+# Returns None when time control given in seconds is out of range, nan or infinite
+def get_valid_time_control(base_time: float, increment: float, delay: float) -> Optional[TimeControl]:
+    if not all(math.isfinite(seconds) for seconds in (base_time, increment, delay)):
+        return None
+    time_control = get_time_control(base_time, increment, delay)
+    return time_control if time_control.is_valid() else None
+
+
+# Creates many full tables with pre-assigned seats at once, returns their ids and seatings,
+# clocks start with the first move
+@router.post("/tables/bulk")
+def create_tables_bulk(request: BulkTablesRequest, db: Session = Depends(get_db)):
+    if not request.tables or len(request.tables) > MAX_TABLES_PER_BULK:
+        return JSONResponse(status_code=400, content="Create 1 to %d tables" % MAX_TABLES_PER_BULK)
+
+    seatings = []
+    all_credentials = set()
+    for table in request.tables:
+        seating = [(seat.nickname, seat.token) for seat in table]
+        if len(seating) != 4 or len({nickname for nickname, _ in seating}) != 4:
+            return JSONResponse(status_code=400, content="Every table needs 4 players with unique nicknames")
+        all_credentials.update(seating)
+        seatings.append(seating)
+    if len(all_credentials) != 4 * len(seatings):
+        return JSONResponse(status_code=400, content="Player can't sit by two tables")
+    time_control = get_valid_time_control(request.base_time, request.increment, request.delay)
+    if time_control is None:
+        return JSONResponse(status_code=400, content=INVALID_TIME_CONTROL)
+
+    tables_ids = gs.create_new_full_tables(seatings, db, time_control)
+    if tables_ids is None:
+        return JSONResponse(status_code=401, content="Can't create games, some players are already in game")
+
+    content = [{'table_id': table_id, 'seats': dict(zip(gs.SEAT_NAMES, [nickname for nickname, _ in seating])),
+                'seat_tokens': {nickname: seat_tokens.create_seat_token(table_id, seat)
+                                for seat, (nickname, _) in enumerate(seating)}}
+               for table_id, seating in zip(tables_ids, seatings)]
+    return JSONResponse(status_code=200, content=content)
+
+
+# Seats player in the fullest table waiting for players, creates new tables when there are none
+@router.post("/tables/quickjoin")
+def quick_join(user_nickname: str, token: str, db: Session = Depends(get_db)):
+    seated = matchmaking.quick_join(user_nickname, token, db)
+    if seated is None:
+        return JSONResponse(status_code=400, content="Unable to join, you may be already in game")
+
+    my_table, started = seated
+    table_changed(my_table, events.EVENT_START if started else events.EVENT_JOIN)
+    seat_token = seat_tokens.create_seat_token(my_table.table_id, my_table.seat_by_nickname[user_nickname])
+    return JSONResponse(status_code=200, content={'table_id': my_table.table_id, 'game_started': started},
+                        headers={'Seat-Token': seat_token})
+
+
 # If player with such credentials does not exists in db, new player is created
 @router.post("/tables/{table_id}")
 def join_table(table_id: int, user_nickname: str, token: str, db: Session = Depends(get_db)):
@@ -17,90 +191,311 @@ def join_table(table_id: int, user_nickname: str, token: str, db: Session = Depe
 
     if my_table.add_player(user_nickname, token, db) is True:
         data = "Successfully joined"
+        event = events.EVENT_JOIN
         if my_table.start_game(db):
             data += ", game started"
+            event = events.EVENT_START
+        table_changed(my_table, event)
+        matchmaking.update_open_table(my_table)
 
-        res = JSONResponse(status_code=200, content=data)
+        seat_token = seat_tokens.create_seat_token(table_id, my_table.seat_by_nickname[user_nickname])
+        res = JSONResponse(status_code=200, content=data, headers={'Seat-Token': seat_token})
         return res
 
     return JSONResponse(status_code=400, content="Table is either full or nickname not unique")
 
 
-# Creates new game instance and returns game id
+# Creates new game instance and returns game id, base time, increment and delay are in seconds
 @router.post("/tables/create/")
-def create_game(user_nickname: str, token: str, db: Session = Depends(get_db)):
-    new_table_id = gs.create_new_table(user_nickname, token, db)
+def create_game(user_nickname: str, token: str, base_time: float = DEFAULT_BASE_TIME,
+                increment: float = DEFAULT_INCREMENT, delay: float = DEFAULT_DELAY, db: Session = Depends(get_db)):
+    time_control = get_valid_time_control(base_time, increment, delay)
+    if time_control is None:
+        return JSONResponse(status_code=400, content=INVALID_TIME_CONTROL)
+
+    new_table_id = gs.create_new_table(user_nickname, token, db, time_control)
     if new_table_id is None:
         return JSONResponse(status_code=400, content="Unable to create new game")
     elif new_table_id == -1:
         return JSONResponse(status_code=401, content="Can't create game, you are already in game")
     else:
-        return JSONResponse(status_code=200, content=str(new_table_id))
+        # Quick join seats players only by tables with default time control
+        if time_control == DEFAULT_TIME_CONTROL:
+            matchmaking.add_created_table(new_table_id)
+        # Creator sits on the first seat
+        return JSONResponse(status_code=200, content=str(new_table_id),
+                            headers={'Seat-Token': seat_tokens.create_seat_token(new_table_id, 0)})
+
+
+# Moves are charged to the seat of authenticated player and to the table, so nobody can spend
+# budgets of another player or freeze a table without credentials
+def charge_mover(table_id: int, seat: int):
+    return too_many_requests([(rate_limit.PLAYER_MOVES, '%d:%d' % (table_id, seat)),
+                              (rate_limit.TABLE_MOVES, table_id)])
+
+
+# Returns seat of player holding valid seat token, or response refusing the request.
+# Seat is None when player is identified by nickname and token, they are checked by authorise_player.
+def authorise_mover(table_id: int, nickname: Optional[str], token: Optional[str], seat_token: Optional[str]):
+    if seat_token is not None:
+        seat = seat_tokens.get_seat_from_token(seat_token, table_id)
+        if seat is None:
+            return None, JSONResponse(status_code=401, content="Invalid or expired seat token")
+        return seat, charge_mover(table_id, seat)
+    if nickname is None or token is None:
+        return None, JSONResponse(status_code=400, content="Seat token or nickname and token required")
+    return None, None
+
+
+# Nickname and token can be checked only against loaded table
+def authorise_player(my_table: gs.Table, nickname: str, token: str):
+    seat = my_table.get_seat_of_player(nickname, token)
+    if seat is None:
+        return None, JSONResponse(status_code=400, content="Bad Request")
+    return seat, charge_mover(my_table.table_id, seat)
 
 
 # Move_string is 4 character length string made out of digits [0-7]
+# Player is identified by Seat-Token header got on create or join, or by nickname and token
 @router.get("/tables/{table_id}/move/")
-def move(table_id: int, nickname: str, token: str, move_string: str, db: Session = Depends(get_db)):
+def move(table_id: int, move_string: str, nickname: Optional[str] = None, token: Optional[str] = None,
+         seat_token: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    seat, res = authorise_mover(table_id, nickname, token, seat_token)
+    if res is not None:
+        return res
+
     db.begin()
-    my_table = gs.get_table_by_id(table_id, db)
+    my_table = gs.get_table_for_move(table_id, db)
     if my_table is None:
         return JSONResponse(status_code=404, content="Such table does not exist")
 
-    if my_table.move(nickname, token, move_string, db):
+    if seat is None:
+        seat, res = authorise_player(my_table, nickname, token)
+        if res is not None:
+            return res
+    moved = my_table.move_from_seat(seat, move_string, db)
+    if moved:
+        table_changed(my_table, events.EVENT_MOVE)
         return JSONResponse(status_code=200, content="OK")
 
     data = my_table.get_result_of_game()
     if data != 400:
-        gs.update_game_result(table_id, data, db)
+        gs.update_game_result(my_table, db)
 
     return JSONResponse(status_code=400, content="Bad Request")
 
 
+# Queues move to be made the instant player's turn comes, replacing the one queued before. When it is
+# player's turn already the move is made at once. Premove which turns out illegal is cancelled.
+@router.post("/tables/{table_id}/premove/")
+def premove(table_id: int, move_string: str, nickname: Optional[str] = None, token: Optional[str] = None,
+            seat_token: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    return set_premove(table_id, move_string, nickname, token, seat_token, db)
+
+
+@router.delete("/tables/{table_id}/premove/")
+def cancel_premove(table_id: int, nickname: Optional[str] = None, token: Optional[str] = None,
+                   seat_token: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    return set_premove(table_id, None, nickname, token, seat_token, db)
+
+
+def set_premove(table_id: int, move_string: Optional[str], nickname: Optional[str], token: Optional[str],
+                seat_token: Optional[str], db: Session):
+    seat, res = authorise_mover(table_id, nickname, token, seat_token)
+    if res is not None:
+        return res
+
+    db.begin()
+    my_table = gs.get_table_for_move(table_id, db)
+    if my_table is None:
+        return JSONResponse(status_code=404, content="Such table does not exist")
+
+    if seat is None:
+        seat, res = authorise_player(my_table, nickname, token)
+        if res is not None:
+            return res
+    moved = my_table.premove_from_seat(seat, move_string, db)
+    if moved is None:
+        return JSONResponse(status_code=400, content="Bad Request")
+    if moved:
+        table_changed(my_table, events.EVENT_MOVE)
+        return JSONResponse(status_code=200, content="OK")
+    if move_string is None:
+        return JSONResponse(status_code=200, content="OK")
+    return JSONResponse(status_code=202, content="Queued")
+
+
 @router.get("/tables/{table_id}/fen/")
-def get_fen(table_id: int, db: Session = Depends(get_db)):
+def get_fen(table_id: int, request: Request, if_none_match: Optional[str] = Header(None),
+            db: Session = Depends(get_read_db)):
+    res = too_many_requests(read_limits(table_id, request)) or not_modified(table_id, if_none_match)
+    if res is not None:
+        return res
+
     my_table = gs.get_table_by_id(table_id, db)
     if my_table is None:
         return JSONResponse(status_code=404, content="Such table does not exist")
 
-    content = my_table.game_state.game_state_to_fen()
-    return JSONResponse(status_code=200, content=content)
+    with my_table.lock():
+        content = my_table.get_fen()
+        etag = read_etag(my_table)
+    return JSONResponse(status_code=200, content=content, headers={'ETag': etag})
 
 
-# Returns string of 4 integers split with spaces of white1, white2, black1, black2 times
+# Returns clocks of players in seconds by their nicknames
+# Last-Move-Time header lets client count down clock of player to move by itself
 @router.get("/tables/{table_id}/times")
-def get_times(table_id: int, db: Session = Depends(get_db)):
-    my_table = gs.get_table_by_id(table_id, db)
+def get_times(table_id: int, request: Request, if_none_match: Optional[str] = Header(None),
+              db: Session = Depends(get_read_db)):
+    res = too_many_requests(read_limits(table_id, request)) or not_modified(table_id, if_none_match)
+    if res is not None:
+        return res
+
+    my_table = gs.get_boardless_table_by_id(table_id, db)
     if my_table is None:
         return JSONResponse(status_code=404, content="Such table does not exist")
 
-    content = my_table.get_times()
-    return JSONResponse(status_code=200, content=content)
+    with my_table.lock():
+        content = my_table.get_times()
+        headers = {'ETag': read_etag(my_table)}
+        if my_table.last_move_ms is not None:
+            headers['Last-Move-Time'] = ms_to_iso(my_table.last_move_ms)
+    return JSONResponse(status_code=200, content=content, headers=headers)
 
 
-# Returns result: 0 is white, 1 is black, 2 is draw, 400 no result
+# Returns result: 0 is white, 1 is black, 2 is draw, 3 is aborted, 400 no result
 @router.get("/tables/{table_id}/result")
-def get_result(table_id: int, db: Session = Depends(get_db)):
+def get_result(table_id: int, request: Request, if_none_match: Optional[str] = Header(None),
+               db: Session = Depends(get_db)):
+    res = too_many_requests(read_limits(table_id, request)) or not_modified(table_id, if_none_match)
+    if res is not None:
+        return res
+
     db.begin()
     my_table = gs.get_table_by_id(table_id, db)
     if my_table is None:
         return JSONResponse(status_code=404, content="Such table does not exist")
 
+    finished = my_table.get_result_value() != 400
     data = my_table.get_result_of_game()
     if data != 400:
-        gs.update_game_result(table_id, data, db)
+        gs.update_game_result(my_table, db)
     db.commit()
-    return JSONResponse(status_code=200, content=data)
+    # Others are told only once, when this request found the result
+    etag = table_changed(my_table, events.EVENT_RESULT) if data != 400 and not finished \
+        else remember_version(my_table)
+    return JSONResponse(status_code=200, content=data, headers={'ETag': etag})
 
 
 # Returns nickname of player expected to move
 @router.get("/tables/{table_id}/who")
-def get_whos_turn(table_id: int, db: Session = Depends(get_db)):
-    my_table = gs.get_table_by_id(table_id, db)
+def get_whos_turn(table_id: int, request: Request, if_none_match: Optional[str] = Header(None),
+                  db: Session = Depends(get_read_db)):
+    res = too_many_requests(read_limits(table_id, request)) or not_modified(table_id, if_none_match)
+    if res is not None:
+        return res
+
+    my_table = gs.get_boardless_table_by_id(table_id, db)
     if my_table is None:
         return JSONResponse(status_code=404, content="Such table does not exist")
 
-    data = {'nickname': my_table.who_to_move()}
-    if data['nickname'] is None or my_table.get_number_of_players() < 4:
+    if my_table.get_number_of_players() < 4:
         return JSONResponse(status_code=400, content="Game hasn't started")
 
-    return JSONResponse(status_code=200, content=data)
+    with my_table.lock():
+        data = {'nickname': my_table.who_to_move()}
+        etag = read_etag(my_table)
+    return JSONResponse(status_code=200, content=data, headers={'ETag': etag})
+
+
+# Returns fen, clocks, player to move, seats, halfmoves and result of the table in one response
+@router.get("/tables/{table_id}/state")
+def get_state(table_id: int, request: Request, if_none_match: Optional[str] = Header(None),
+              db: Session = Depends(get_db)):
+    res = too_many_requests(read_limits(table_id, request)) or not_modified(table_id, if_none_match)
+    if res is not None:
+        return res
+
+    db.begin()
+    my_table = gs.get_table_by_id(table_id, db)
+    if my_table is None:
+        return JSONResponse(status_code=404, content="Such table does not exist")
+
+    finished = my_table.get_result_value() != 400
+    result = my_table.get_result_of_game()
+    if result != 400:
+        gs.update_game_result(my_table, db)
+    db.commit()
+    if result != 400 and not finished:
+        table_changed(my_table, events.EVENT_RESULT)
+    # Payload and its etag come from the same version of live table
+    with my_table.lock():
+        payload = get_state_payload(my_table)
+        etag = remember_version(my_table)
+    return Response(status_code=200, content=payload, media_type="application/json", headers={'ETag': etag})
+
+
+# Flag fall which woke the waiter is saved with its leaderboard events and told to others once,
+# like result found by get_result
+def save_found_result(my_table: gs.Table):
+    if my_table.get_result_value() == 400 and my_table.get_result_of_game() != 400:
+        waiters.save_result(my_table)
+        table_changed(my_table, events.EVENT_RESULT)
+
+
+# Returns state payload and its etag, payload is None when table hasn't changed. Live table is read
+# under its lock, so it runs in the threadpool and never blocks the event loop.
+def get_wait_response(my_table: gs.Table, since: int) -> Tuple[Optional[bytes], str]:
+    if waiters.has_changed(my_table, since):
+        save_found_result(my_table)
+    with my_table.lock():
+        etag = get_etag(my_table)
+        if not waiters.has_changed(my_table, since):
+            return None, etag
+        return get_state_payload(my_table), etag
+
+
+# Long poll: answers with state as soon as game moves past ply since or gets result, 304 when timeout
+# (in seconds) elapses first. Waiting request holds no thread and no database connection.
+@router.get("/tables/{table_id}/wait")
+async def wait_for_change(table_id: int, since: int, request: Request,
+                          timeout: float = waiters.DEFAULT_WAIT_TIMEOUT):
+    res = too_many_requests(read_limits(table_id, request))
+    if res is not None:
+        return res
+
+    # Nan would pass clamping and make the request wait forever
+    if not math.isfinite(timeout):
+        return JSONResponse(status_code=400, content="Timeout must be a finite number of seconds")
+    timeout = min(max(timeout, 0.0), waiters.MAX_WAIT_TIMEOUT)
+    my_table = await waiters.wait_for_change(table_id, since, timeout)
+    if my_table is None:
+        return JSONResponse(status_code=404, content="Such table does not exist")
+
+    payload, etag = await run_in_threadpool(get_wait_response, my_table, since)
+    if payload is None:
+        return Response(status_code=304, headers={'ETag': etag})
+    return Response(status_code=200, content=payload, media_type="application/json", headers={'ETag': etag})
+
+
+# Streams state of the table as server-sent events, one event per change, until game has a result.
+# Slow spectator gets only the newest states.
+@router.get("/tables/{table_id}/watch")
+async def watch_table(table_id: int, request: Request):
+    res = too_many_requests(read_limits(table_id, request))
+    if res is not None:
+        return res
+    subscriber = await spectators.subscribe(table_id)
+    if subscriber is None:
+        return JSONResponse(status_code=404, content="Such table does not exist or has too many spectators")
+    return StreamingResponse(spectators.stream(table_id, subscriber), media_type="text/event-stream",
+                             headers={'Cache-Control': 'no-cache'})
+
+
+# Requests admitted and refused by every rate limiter, with keys refused most often. Internal, answers
+# only requests with Admin-Token header matching RATE_LIMITS_ADMIN_TOKEN, others get 404.
+@router.get("/rate-limits")
+def get_rate_limits(admin_token: Optional[str] = Header(None)):
+    if not rate_limit.is_admin_token(admin_token):
+        return JSONResponse(status_code=404, content="Not Found")
+    return JSONResponse(status_code=200, content=rate_limit.get_counters())
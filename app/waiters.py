@@ -0,0 +1,121 @@
+# Long-poll requests parked until their table changes. Parked request is a future on the event loop,
+# so it costs no thread. Changes made by this worker wake waiters at once and hand them the changed table;
+# changes made by other workers are found by one batched load of all waited tables every
+# WAIT_RECHECK_INTERVAL seconds.
+import asyncio
+import os
+
+from starlette.concurrency import run_in_threadpool
+
+import app.game_server as gs
+from app.database import SessionLocal, get_engine
+
+# Seconds, client may ask for shorter wait
+DEFAULT_WAIT_TIMEOUT = float(os.getenv("DEFAULT_WAIT_TIMEOUT", "25"))
+MAX_WAIT_TIMEOUT = float(os.getenv("MAX_WAIT_TIMEOUT", "60"))
+# Seconds between checks of tables changed by other workers, 0 turns checks off
+WAIT_RECHECK_INTERVAL = float(os.getenv("WAIT_RECHECK_INTERVAL", "2"))
+
+# table_id -> set of futures of parked requests, touched only from the event loop
+WAITERS = {}
+loop = None
+recheck_task = None
+
+
+def load_table(table_id: int):
+    get_engine()
+    db = SessionLocal()
+    try:
+        return gs.get_table_by_id(table_id, db)
+    finally:
+        db.close()
+
+
+def load_tables(tables_ids):
+    get_engine()
+    db = SessionLocal()
+    try:
+        return gs.get_tables_by_ids_db(tables_ids, db)
+    finally:
+        db.close()
+
+
+# Saves result found by waiting request, e.g. flag fall nobody else has noticed yet
+def save_result(table: gs.Table):
+    get_engine()
+    db = SessionLocal()
+    try:
+        gs.update_game_result(table, db)
+    finally:
+        db.close()
+
+
+# Table has moved past ply since, got result or player to move has run out of time
+def has_changed(table: gs.Table, since: int) -> bool:
+    if table.half_moves > since or table.get_result_value() != gs.Result.no_result.value:
+        return True
+    seconds_to_flag = table.get_seconds_to_flag()
+    return seconds_to_flag is not None and seconds_to_flag < 0
+
+
+def wake_waiters(table: gs.Table):
+    futures = WAITERS.pop(table.table_id, None)
+    if futures:
+        for future in futures:
+            if not future.done():
+                future.set_result(table)
+
+
+# Called from request threads after table was changed
+def notify_table_changed(table: gs.Table):
+    if loop is not None and table.table_id in WAITERS:
+        loop.call_soon_threadsafe(wake_waiters, table)
+
+
+async def recheck_waited_tables():
+    while True:
+        await asyncio.sleep(WAIT_RECHECK_INTERVAL)
+        if not WAITERS:
+            continue
+        try:
+            tables = await run_in_threadpool(load_tables, list(WAITERS))
+        except Exception as e:
+            print("WAIT RECHECK FAILED", e)
+            continue
+        # Woken waiters park again when their table hasn't changed
+        for table in tables:
+            wake_waiters(table)
+
+
+# Returns changed table, table as it is when timeout elapsed or None when table doesn't exist.
+# Result of flag fall which woke the waiter is left to the caller
+async def wait_for_change(table_id: int, since: int, timeout: float):
+    global loop, recheck_task
+    loop = asyncio.get_running_loop()
+    if WAIT_RECHECK_INTERVAL > 0 and (recheck_task is None or recheck_task.get_loop() is not loop):
+        recheck_task = loop.create_task(recheck_waited_tables())
+
+    deadline = loop.time() + timeout
+    table = await run_in_threadpool(load_table, table_id)
+    while table is not None and not has_changed(table, since):
+        wait_seconds = deadline - loop.time()
+        if wait_seconds <= 0:
+            break
+        # Nobody moves when flag falls, so wake up for it
+        seconds_to_flag = table.get_seconds_to_flag()
+        if seconds_to_flag is not None:
+            wait_seconds = min(wait_seconds, seconds_to_flag)
+
+        future = loop.create_future()
+        WAITERS.setdefault(table_id, set()).add(future)
+        try:
+            table = await asyncio.wait_for(future, wait_seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            futures = WAITERS.get(table_id)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del WAITERS[table_id]
+    return table
@@ -0,0 +1,55 @@
+# Counts move paths of given depth from well-known positions and compares them with published numbers,
+# fails on any difference. Positions and depths are chosen so that no pawn promotes, engine promotes
+# only to queen while published numbers count all four pieces.
+# Usage: python -m benchmarks.perft [max_depth]
+import sys
+import time
+
+import app.engine.chessEngine as engine
+
+DEFAULT_MAX_DEPTH = 3
+
+# (name, fen, nodes at depth 1, 2, ...)
+PERFT_POSITIONS = [
+    ('start', "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", [20, 400, 8902, 197281]),
+    # Castling through attacked squares, pins and checks
+    ('kiwipete', "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862]),
+    # En passant which would leave king in check along the row
+    ('endgame', "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238]),
+]
+
+
+def perft(game_state: engine.GameState, depth: int) -> int:
+    moves = game_state.get_legal_moves(game_state.color_to_move)
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        _, response_game_state = game_state.is_move_legal(*engine.decode_move(move))
+        undo_record = game_state.make_move(response_game_state)
+        nodes += perft(game_state, depth - 1)
+        game_state.unmake_move(undo_record)
+    return nodes
+
+
+def main():
+    max_depth = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MAX_DEPTH
+
+    wrong = []
+    for name, fen, expected_nodes in PERFT_POSITIONS:
+        game_state = engine.GameState()
+        game_state.load_game_state_from_fen(fen)
+        for depth, expected in enumerate(expected_nodes[:max_depth], 1):
+            start = time.perf_counter()
+            nodes = perft(game_state, depth)
+            print("%-10s depth %d: %8d / %8d  %.2fs" % (name, depth, nodes, expected, time.perf_counter() - start))
+            if nodes != expected:
+                wrong.append("%s depth %d" % (name, depth))
+
+    if wrong:
+        print("Wrong number of nodes:", ", ".join(wrong))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Counts SQL statements every endpoint sends to the database, fails when any route is over its budget
+# Usage: SQLALCHEMY_DATABASE_URL=... SEAT_TOKEN_SECRET=... python -m benchmarks.query_budget
+# Database has to have schema from app/db.sql, players created here get random nicknames.
+import sys
+import uuid
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app.database import get_engine, get_read_engine
+from main import app
+
+# Statements allowed per request
+QUERY_BUDGETS = {
+    'create table': 3,
+    'join table': 4,
+    'join and start': 5,
+    'fen': 1,
+    'fen not modified': 0,
+    'times': 1,
+    'who': 1,
+    'result': 1,
+    'state': 1,
+    # Lock of games row, table, clock of player who moved, game
+    'move': 4,
+    'batch': 1,
+    'live': 1,
+}
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+# Yields (route name, request), statements run between requests are not counted
+def run_routes(client: TestClient):
+    suffix = uuid.uuid4().hex[:8]
+    nicknames = ['budget_%d_%s' % (seat, suffix) for seat in range(4)]
+    response = client.post("/tables/create/", params={'user_nickname': nicknames[0], 'token': 't'})
+    table_id = int(response.json())
+    yield 'create table', lambda: client.post("/tables/create/", params={'user_nickname': 'budget_' + suffix,
+                                                                          'token': 't'})
+
+    def join(seat):
+        return lambda: client.post("/tables/%d" % table_id, params={'user_nickname': nicknames[seat], 'token': 't'})
+
+    yield 'join table', join(1)
+    join(2)()
+    yield 'join and start', join(3)
+
+    table_url = "/tables/%d" % table_id
+    yield 'fen', lambda: client.get(table_url + "/fen/")
+    etag = client.get(table_url + "/fen/").headers['ETag']
+    yield 'fen not modified', lambda: client.get(table_url + "/fen/", headers={'If-None-Match': etag})
+    yield 'times', lambda: client.get(table_url + "/times")
+    yield 'who', lambda: client.get(table_url + "/who")
+    yield 'result', lambda: client.get(table_url + "/result")
+    yield 'state', lambda: client.get(table_url + "/state")
+    yield 'move', lambda: client.get(table_url + "/move/", params={'nickname': nicknames[0], 'token': 't',
+                                                                   'move_string': '4143'})
+    yield 'batch', lambda: client.get("/tables/batch", params={'ids': str(table_id)})
+    yield 'live', lambda: client.get("/tables/live", params={'limit': 1})
+
+
+def main():
+    counter = QueryCounter()
+    engines = {get_engine(), get_read_engine()}
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', counter)
+
+    over_budget = []
+    client = TestClient(app)
+    for name, call in run_routes(client):
+        counter.count = 0
+        call()
+        print("%-18s %d / %d" % (name, counter.count, QUERY_BUDGETS[name]))
+        if counter.count > QUERY_BUDGETS[name]:
+            over_budget.append(name)
+
+    if over_budget:
+        print("Over the budget:", ", ".join(over_budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
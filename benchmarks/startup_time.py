@@ -0,0 +1,44 @@
+# Measures how long fresh worker takes to import the app, fails when it is over the budget
+# Usage: python -m benchmarks.startup_time [runs] [budget_in_seconds]
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_RUNS = 10
+DEFAULT_BUDGET = 1.0
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# App refuses to start without the secret, its value doesn't matter here
+WORKER_ENV = dict(os.environ, SEAT_TOKEN_SECRET=os.getenv("SEAT_TOKEN_SECRET") or "startup-benchmark")
+
+
+def measure_startup() -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main; main.app"], cwd=REPO_ROOT, env=WORKER_ENV, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BUDGET
+
+    # Bare interpreter start is not something we can make faster, report it separately
+    interpreter_start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    interpreter_time = time.perf_counter() - interpreter_start
+
+    times = [measure_startup() for _ in range(runs)]
+    median = statistics.median(times)
+    print("interpreter:    %.3fs" % interpreter_time)
+    print("startup median: %.3fs, max: %.3fs (%d runs)" % (median, max(times), runs))
+    print("budget:         %.3fs" % budget)
+
+    if median > budget:
+        print("Startup is over the budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
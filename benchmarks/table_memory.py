@@ -0,0 +1,34 @@
+# Reports how many bytes one live table (game state, players, clocks) takes in memory
+# Usage: python -m benchmarks.table_memory [number_of_tables]
+import sys
+import tracemalloc
+
+import app.engine.chessEngine as engine
+from app.clock import DEFAULT_TIME_CONTROL, now_ms
+from app.game_server import PlayerByTable, Table
+
+DEFAULT_NUMBER_OF_TABLES = 10000
+
+
+def build_table(table_id: int) -> Table:
+    time_ms = now_ms()
+    players = [PlayerByTable("player_%d_%d" % (table_id, seat), "token_%d_%d" % (table_id, seat),
+                             DEFAULT_TIME_CONTROL.base_ms, 4 * table_id + seat) for seat in range(4)]
+    return Table(engine.GameState(), table_id, 0, *players, time_ms, time_ms)
+
+
+def main():
+    number_of_tables = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER_OF_TABLES
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tables = [build_table(table_id) for table_id in range(number_of_tables)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("live tables:     %d" % len(tables))
+    print("bytes per table: %d" % ((after - before) // number_of_tables))
+
+
+if __name__ == '__main__':
+    main()
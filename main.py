@@ -1,5 +1,9 @@
 from fastapi import FastAPI
 from app.views import router as views_router
+from app.events import start_bus
+from app.journal import close_journal, open_journal
+from app.outbox import start_relay
+from app.reaper import start_reaper
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI()
@@ -12,6 +16,13 @@ app.add_middleware(
   allow_credentials=True,
   allow_methods=["*"],
   allow_headers=["*"],
+  expose_headers=["Seat-Token", "ETag", "Last-Move-Time", "Retry-After"],
 )
 
 app.include_router(views_router)
+
+app.add_event_handler("startup", open_journal)
+app.add_event_handler("startup", start_reaper)
+app.add_event_handler("startup", start_relay)
+app.add_event_handler("startup", start_bus)
+app.add_event_handler("shutdown", close_journal)